@@ -9,3 +9,5 @@ USER_MANAGEMENT_CLIENT_PATH = ENV.str("USER_MANAGEMENT_CLIENT_PATH")
 USER_MANAGEMENT_ENABLE_SIGNALS = ENV.bool("USER_MANAGEMENT_ENABLE_SIGNALS")
 MANAGE_GROUPS_AT_PROJECT_LEVEL = ENV.bool("MANAGE_GROUPS_AT_PROJECT_LEVEL")
 USER_MANAGEMENT_REMOVE_USERS_ON_PROJECT_ARCHIVE = ENV.bool("USER_MANAGEMENT_REMOVE_USERS_ON_PROJECT_ARCHIVE")
+USER_MANAGEMENT_STRICT_STARTUP_CHECK = ENV.bool("USER_MANAGEMENT_STRICT_STARTUP_CHECK", default=False)
+USER_MANAGEMENT_SYNC_CONCURRENCY = ENV.int("USER_MANAGEMENT_SYNC_CONCURRENCY", default=8)
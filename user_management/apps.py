@@ -19,12 +19,17 @@ class UserManagementConfig(AppConfig):
 
     def ready(self):
         UserManagementConfig.validate_settings()
-        # tests whether the client has the appropriate configuration and any dependencies can be imported
-        logger.debug("Testing UserManagementClient configuration...")
-        # pylint: disable=import-outside-toplevel
-        from user_management.utils import get_client_class
+        # registers the client configuration check that runs with `manage.py check`
+        # pylint: disable=import-outside-toplevel,unused-import
+        from user_management import checks  # noqa: F401
 
-        get_client_class().test_config()
+        if getattr(settings, "USER_MANAGEMENT_STRICT_STARTUP_CHECK", False):
+            # tests whether the client has the appropriate configuration and any dependencies can be imported
+            logger.debug("Testing UserManagementClient configuration...")
+            # pylint: disable=import-outside-toplevel
+            from user_management.utils import get_client_class
+
+            get_client_class().test_config()
 
         if settings.USER_MANAGEMENT_ENABLE_SIGNALS:
             logger.info("Initializing User Management Plugin signal receivers...")
@@ -66,3 +71,10 @@ class UserManagementConfig(AppConfig):
         for st in string_plugin_settings:
             if not isinstance(getattr(settings, st), str) and getattr(settings, st) is not None:
                 raise ImproperlyConfigured(f"{st} must be a string or None.")
+
+        # optional settings
+        if not isinstance(getattr(settings, "USER_MANAGEMENT_STRICT_STARTUP_CHECK", False), bool):
+            raise ImproperlyConfigured("USER_MANAGEMENT_STRICT_STARTUP_CHECK must be a boolean.")
+        sync_concurrency = getattr(settings, "USER_MANAGEMENT_SYNC_CONCURRENCY", 8)
+        if not isinstance(sync_concurrency, int) or isinstance(sync_concurrency, bool) or sync_concurrency < 1:
+            raise ImproperlyConfigured("USER_MANAGEMENT_SYNC_CONCURRENCY must be a positive integer.")
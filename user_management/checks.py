@@ -0,0 +1,29 @@
+from django.core.checks import Error, register
+
+
+@register()
+def check_user_management_client(app_configs, **kwargs):
+    """
+    Checks that exactly one UserManagementClient implementation can be loaded from the configured
+    client path and that its configuration is valid. Runs with `manage.py check` rather than on
+    every process startup.
+    """
+    # pylint: disable=import-outside-toplevel
+    from user_management.utils import get_client_class
+
+    try:
+        client_class = get_client_class()
+    except ImportError as e:
+        return [Error(str(e), hint="Check USER_MANAGEMENT_CLIENT_PATH.", id="user_management.E001")]
+
+    try:
+        client_class.test_config()
+    # pylint: disable=broad-except
+    except Exception as e:
+        return [
+            Error(
+                f"User management client {client_class.__name__} is not properly configured: {e}",
+                id="user_management.E002",
+            )
+        ]
+    return []
@@ -1,10 +1,120 @@
+import functools
 import importlib
 import logging
 import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from typing import Optional
 
 logger = logging.getLogger(__name__)
 
 
+@dataclass(frozen=True)
+class GrouperConfig:
+    """Grouper client settings read from the environment."""
+
+    api_url: Optional[str]
+    entity_id: Optional[str]
+    key_path: Optional[str]
+    group_stem: Optional[str]
+
+
+@functools.lru_cache(maxsize=1)
+def _load_config() -> GrouperConfig:
+    """Reads the Grouper settings from the environment once per process."""
+    return GrouperConfig(
+        api_url=os.getenv("GROUPER_API_URL"),
+        entity_id=os.getenv("GROUPER_ENTITY_ID"),
+        key_path=os.getenv("GROUPER_KEY_PATH"),
+        group_stem=os.getenv("GROUPER_GROUP_STEM"),
+    )
+
+
+# requests isn't a dependency of the plugin, so it's imported where it's used, like grouper_client
+def _mount_pooled_adapter(session):
+    # pylint: disable=import-outside-toplevel
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    adapter = HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=32,
+        max_retries=Retry(total=3, backoff_factor=0.2, status_forcelist=[502, 503, 504]),
+    )
+    session.mount("https://", adapter)
+    return session
+
+
+@functools.lru_cache(maxsize=1)
+def _shared_session():
+    """
+    Returns the process-wide session used by clients whose Grouper library doesn't bring its own.
+    get_client() builds a client per call, so keeping the session here lets them all reuse its connections.
+    """
+    # pylint: disable=import-outside-toplevel
+    import requests
+
+    return _mount_pooled_adapter(requests.Session())
+
+
+def _raise_if_unavailable(error):
+    """
+    Re-raises failures that every later request would hit too: the builtin ConnectionError when Grouper
+    can't be reached and PermissionError when it refuses the client. Callers then stop instead of trying
+    each remaining group. Other errors are left to the caller's handling.
+    """
+    if isinstance(error, (ConnectionError, PermissionError)):
+        raise error
+    # an error from requests can only be raised once requests has been imported
+    requests_exceptions = sys.modules.get("requests.exceptions")
+    if requests_exceptions is not None and isinstance(error, requests_exceptions.ConnectionError):
+        raise ConnectionError(f"Grouper can't be reached: {error}") from error
+    if getattr(getattr(error, "response", None), "status_code", None) in (401, 403):
+        raise PermissionError(f"Grouper refused the request: {error}") from error
+
+
+class _TTLCache:
+    """
+    Small LRU cache whose entries expire after ttl seconds.
+    Used to avoid asking Grouper the same question repeatedly within a short window.
+    Access is locked so one client can be shared by worker threads.
+    """
+
+    def __init__(self, maxsize=4096, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the cached value for key, or None if it is missing or expired."""
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expires_at = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
 class UserManagementClient:
     """
     Implements Coldfront UserManagementClientInterface using Grouper.
@@ -13,21 +123,51 @@ class UserManagementClient:
     def __init__(self):
         try:
             grouper_client = importlib.import_module("grouper_client")
-            self.client = grouper_client.GrouperClient(*self.get_config().values())
+            config = _load_config()
+            self.client = grouper_client.GrouperClient(
+                config.api_url, config.entity_id, config.key_path, config.group_stem
+            )
         except Exception as e:
             raise ImportError("Grouper client library is not installed. Please install it.") from e
+        self._configure_session()
+        # group existence and membership lookups are cached briefly; writes through this client keep them current
+        self._group_exists_cache = _TTLCache(maxsize=4096, ttl=60)
+        self._membership_cache = _TTLCache(maxsize=4096, ttl=60)
+
+    def _configure_session(self):
+        """
+        Makes the Grouper client reuse pooled keep-alive connections so bursts of calls
+        don't pay for a new TCP and TLS handshake each time. A Grouper client whose session is
+        unset is given the process-wide one shared by every client instance.
+        Pooling is skipped, with a warning, when the Grouper client doesn't make its requests through a session.
+        """
+        if not hasattr(self.client, "session"):
+            logger.warning("Grouper client has no session attribute; HTTP connection pooling is not applied.")
+            return
+        try:
+            # pylint: disable=import-outside-toplevel
+            import requests
+        except ImportError:
+            logger.warning("requests is not installed; HTTP connection pooling is not applied.")
+            return
+        session = self.client.session
+        if isinstance(session, requests.Session):
+            _mount_pooled_adapter(session)
+        elif session is None:
+            self.client.session = _shared_session()
+        else:
+            logger.warning(
+                "Grouper client session is a %s, not a requests.Session; HTTP connection pooling is not applied.",
+                type(session).__name__,
+            )
 
     @staticmethod
     def get_config():
         """
         Retrieves the configuration for the Grouper client from environment variables.
+        The environment is only read the first time; later calls return a copy of the cached values.
         """
-        return {
-            "api_url": os.getenv("GROUPER_API_URL"),
-            "entity_id": os.getenv("GROUPER_ENTITY_ID"),
-            "key_path": os.getenv("GROUPER_KEY_PATH"),
-            "group_stem": os.getenv("GROUPER_GROUP_STEM"),
-        }
+        return asdict(_load_config())
 
     @staticmethod
     def test_config():
@@ -39,53 +179,157 @@ class UserManagementClient:
             _ = importlib.import_module("grouper_client")
         except Exception as e:
             raise ImportError("Grouper client library is not installed. Please install it.") from e
-        config = UserManagementClient.get_config()
-        if not config["api_url"] or not config["entity_id"] or not config["key_path"] or not config["group_stem"]:
+        config = _load_config()
+        if not config.api_url or not config.entity_id or not config.key_path or not config.group_stem:
             raise ValueError("Grouper client is not properly configured. Please check your environment variables.")
 
     def add_user_to_group(self, user, group):
         try:
             r = self.client.add_members_to_group(group, [user])
             logger.debug("Grouper add_members_to_group response: %s", r)
+            self._membership_cache.set((user, group), True)
             return True
         except IOError as e:
             logger.error("Failed to add user %s to group %s: %s", user, group, e)
+            _raise_if_unavailable(e)
             return False
 
     def remove_user_from_group(self, user, group):
         try:
             r = self.client.remove_members_from_group(group, [user])
             logger.debug("Grouper remove_members_from_group response: %s", r)
+            self._membership_cache.set((user, group), False)
             return True
         except IOError as e:
             logger.error("Failed to remove user %s from group %s: %s", user, group, e)
+            _raise_if_unavailable(e)
+            return False
+
+    def add_users_to_group(self, users, group):
+        """Adds all users to the group with a single Grouper membership request."""
+        users = list(users)
+        try:
+            r = self.client.add_members_to_group(group, users)
+            logger.debug("Grouper add_members_to_group response: %s", r)
+            for user in users:
+                self._membership_cache.set((user, group), True)
+            return True
+        except IOError as e:
+            logger.error("Failed to add users %s to group %s: %s", users, group, e)
+            _raise_if_unavailable(e)
+            return False
+
+    def remove_users_from_group(self, users, group):
+        """Removes all users from the group with a single Grouper membership request."""
+        users = list(users)
+        try:
+            r = self.client.remove_members_from_group(group, users)
+            logger.debug("Grouper remove_members_from_group response: %s", r)
+            for user in users:
+                self._membership_cache.set((user, group), False)
+            return True
+        except IOError as e:
+            logger.error("Failed to remove users %s from group %s: %s", users, group, e)
+            _raise_if_unavailable(e)
             return False
 
     def user_in_group(self, user, group):
+        cached = self._membership_cache.get((user, group))
+        if cached is not None:
+            return cached
         try:
-            return self.client.is_user_in_group(group, user)
+            in_group = self.client.is_user_in_group(group, user)
+            self._membership_cache.set((user, group), in_group)
+            return in_group
         except IOError as e:
             logger.error("Failed to check if user %s is in group %s: %s", user, group, e)
+            _raise_if_unavailable(e)
             return False
 
     def group_exists(self, group):
+        cached = self._group_exists_cache.get(group)
+        if cached is not None:
+            return cached
         try:
-            return self.client.group_exists(group)
+            exists = self.client.group_exists(group)
+            self._group_exists_cache.set(group, exists)
+            return exists
         except IOError as e:
             logger.error("Failed to check if group %s exists: %s", group, e)
+            _raise_if_unavailable(e)
             return False
 
-    def get_group_members(self, group):
+    def groups_exist(self, groups):
+        """
+        Returns a dict mapping each group name to whether it exists. Groups that aren't cached are looked up
+        one at a time. Groups whose lookup fails are left out, so the caller checks them again rather than
+        treating them as missing.
+        """
+        result = {}
+        for group in groups:
+            cached = self._group_exists_cache.get(group)
+            if cached is not None:
+                result[group] = cached
+                continue
+            try:
+                result[group] = self.client.group_exists(group)
+            except IOError as e:
+                logger.error("Failed to check if group %s exists: %s", group, e)
+                _raise_if_unavailable(e)
+                continue
+            self._group_exists_cache.set(group, result[group])
+        return result
+
+    def iter_group_members(self, group):
+        """
+        Yields the members of a group. If the Grouper client can page through results,
+        members are yielded as each page arrives instead of after the whole group is loaded.
+        A failed request raises IOError, even partway through, so callers never mistake part of a group for all of it.
+        """
         try:
-            return self.client.get_group_members(group).values()
+            if hasattr(self.client, "iter_group_members"):
+                for page in self.client.iter_group_members(group):
+                    yield from page.values()
+            else:
+                yield from self.client.get_group_members(group).values()
         except IOError as e:
             logger.error("Failed to get members of group %s: %s", group, e)
-            return []
+            _raise_if_unavailable(e)
+            raise
+
+    def get_group_members(self, group):
+        """
+        Returns the members of a group as a set, so membership checks on large groups are hash lookups.
+        Raises IOError if the members couldn't all be read.
+        """
+        return set(self.iter_group_members(group))
+
+    def get_group_members_bulk(self, groups, max_workers=16):
+        """
+        Returns a dict mapping each group name to its members, fetching the groups concurrently.
+        max_workers bounds the number of simultaneous Grouper requests. Raises IOError if any group can't be read.
+        """
+        groups = list(groups)
+        if not groups:
+            return {}
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(groups))) as executor:
+            return dict(zip(groups, executor.map(self.get_group_members, groups)))
 
     def create_group(self, group):
         try:
             self.client.create_group(group)
+            self._group_exists_cache.set(group, True)
             return True
         except IOError as e:
             logger.error("Failed to create group %s: %s", group, e)
+            _raise_if_unavailable(e)
             return False
+
+    def clear_caches(self):
+        """Discards cached group existence and membership lookups."""
+        self._group_exists_cache.clear()
+        self._membership_cache.clear()
+
+
+# lets get_client_class() pick this class without scanning the module
+USER_MANAGEMENT_CLIENT_CLASS = UserManagementClient
@@ -1,16 +1,45 @@
 import csv
 import json
 import logging
-import os
+import textwrap
+from collections.abc import Iterable, Iterator
+from pathlib import Path
 
-import coldfront.core.allocation.models as allocation_models
-import coldfront.core.project.models as project_models
 from django.conf import settings
 from django.core.management.base import BaseCommand
 
 logger = logging.getLogger(__name__)
 
 
+PROJECT_FIELDS = ("project", "pi_username", "group")
+ALLOCATION_FIELDS = ("project", "pi_username", "allocation", "allocation_id", "group")
+
+
+def _write_csv(fieldnames: tuple, rows: Iterable[tuple], output_file: str) -> None:
+    # rows are written as they are produced so the full result set is never held in memory
+    with open(output_file, mode="w", encoding="utf-8", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(fieldnames)
+        writer.writerows(rows)
+    logger.info("Wrote to csv output file %s.", output_file)
+
+
+def _write_json(fieldnames: tuple, rows: Iterable[tuple], output_file: str) -> None:
+    # emit the list one element at a time, matching the layout of json.dump(rows, indent=4)
+    with open(output_file, mode="w", encoding="utf-8") as file:
+        file.write("[")
+        empty = True
+        for row in rows:
+            file.write("\n" if empty else ",\n")
+            file.write(textwrap.indent(json.dumps(dict(zip(fieldnames, row)), indent=4), " " * 4))
+            empty = False
+        file.write("]" if empty else "\n]")
+    logger.info("Wrote to json output file %s.", output_file)
+
+
+_WRITERS = {"csv": _write_csv, "json": _write_json}
+
+
 class Command(BaseCommand):
     help = "Gather information about projects or allocations to help set group attributes"
 
@@ -22,13 +51,15 @@ class Command(BaseCommand):
             choices=["project", "allocation"],
             required=False,
         )
-        parser.add_argument("-n", "--include-new", help="Include 'New' projects or allocations", action="store_true", default=False)
+        parser.add_argument(
+            "-n", "--include-new", help="Include 'New' projects or allocations", action="store_true", default=False
+        )
         parser.add_argument("-o", "--output-file", help="Path to output file for saving group updates", required=True)
-        parser.add_argument("-f", "--format", help="json or csv output", default=None)
+        parser.add_argument("-f", "--format", help="json or csv output", choices=list(_WRITERS), default=None)
 
     @staticmethod
-    def parse_alignment(alignment):
-        default_alignment = "project" if settings.MANAGE_GROUPS_AT_PROJECT_LEVEL else "allocation"
+    def parse_alignment(alignment, manage_groups_at_project_level):
+        default_alignment = "project" if manage_groups_at_project_level else "allocation"
         if alignment not in ["project", "allocation", None]:
             logger.error("Invalid alignment specified. Must be 'project' or 'allocation'.")
             raise ValueError("Invalid alignment specified. Must be 'project' or 'allocation'.")
@@ -42,122 +73,168 @@ class Command(BaseCommand):
         logger.info("Setting group alignment at the '%s' level.", alignment)
         return alignment
 
-    def handle_output(self, rows: list[dict], output_file: str, output_format: str) -> None:
-        # write differences to output file
-        if output_format == "csv" or (output_format != "json" and output_file.endswith(".csv")):
-            with open(output_file, mode="w", encoding="utf-8", newline="") as file:
-                fieldnames = rows[0].keys() if rows else []
-                writer = csv.DictWriter(file, fieldnames=fieldnames)
-                writer.writeheader()
-                for row in rows:
-                    writer.writerow(row)
-                logger.info("Wrote to csv output file %s.", output_file)
-        elif output_format == "json" or (output_format != "csv" and output_file.endswith(".json")):
-            with open(output_file, mode="w", encoding="utf-8") as file:
-                json.dump(rows, file, indent=4)
-                logger.info("Wrote to json output file %s.", output_file)
-
-    def get_group_attribute_info_for_projects(self, group_attribute_name: str, include_new: bool = False) -> list[dict]:
+    @staticmethod
+    def resolve_output_format(output_file: str, output_format: str) -> str:
+        # an explicit format wins; otherwise it comes from the output file's extension
+        fmt = (output_format or Path(output_file).suffix.lstrip(".")).lower()
+        if fmt not in _WRITERS:
+            logger.error("Unsupported output format '%s'. Must be 'csv' or 'json'.", fmt)
+            raise ValueError(f"Unsupported output format '{fmt}'. Must be 'csv' or 'json'.")
+        return fmt
+
+    def handle_output(self, fieldnames: tuple, rows: Iterable[tuple], output_file: str, output_format: str) -> None:
+        _WRITERS[self.resolve_output_format(output_file, output_format)](fieldnames, rows, output_file)
+
+    def get_group_attribute_info_for_projects(
+        self, group_attribute_name: str, include_new: bool = False
+    ) -> Iterator[tuple]:
+        """Yields a row of PROJECT_FIELDS values for each project."""
+        # pylint: disable=import-outside-toplevel
+        import coldfront.core.project.models as project_models
+
         logger.info("Getting group attribute info at the project level...")
-        info = []
         # get a list of projects
         if include_new:
             projects = project_models.Project.objects.filter(status__name__in=["Active", "New"])
         else:
             projects = project_models.Project.objects.filter(status__name="Active")
-        logger.info("Found %d active projects.", projects.count())
-        for project in projects:
+        # map each project to its group attribute value in one narrow query
+        group_by_project = {}
+        project_attributes = (
+            project_models.ProjectAttribute.objects.filter(
+                project__in=projects.values("pk"), proj_attr_type__name=group_attribute_name
+            )
+            .order_by("pk")
+            .values_list("project_id", "value")
+        )
+        for project_id, value in project_attributes.iterator(chunk_size=2000):
+            # assuming only one attribute of this type per project
+            group_by_project.setdefault(project_id, value)
+
+        # only fetch the columns that are written out; no model instances are built
+        # per-row messages are DEBUG only; a summary is logged at INFO once the rows are written
+        debug_enabled = logger.isEnabledFor(logging.DEBUG)
+        with_group = without_group = 0
+        for project in projects.values("pk", "title", "pi__username").iterator(chunk_size=2000):
             # check if the current project has the group attribute defined
-            project_attributes = project.projectattribute_set.filter(proj_attr_type__name=group_attribute_name)
-            if project_attributes.exists():
-                logger.info("  Project %s has group attribute defined.", project.title)
-                info.append(
-                    {
-                        "project": project.title,
-                        "pi_username": project.pi.username,
-                        "group": project_attributes.first().value,  # assuming only one attribute of this type per project
-                    }
-                )
+            if project["pk"] in group_by_project:
+                with_group += 1
+                if debug_enabled:
+                    logger.debug("  Project %s has group attribute defined.", project["title"])
             else:
-                logger.info("  Project %s does not have group attribute defined.", project.title)
-                info.append(
-                    {
-                        "project": project.title,
-                        "pi_username": project.pi.username,
-                        "group": "",
-                    }
-                )
-        return info
-
-    def get_group_attribute_info_for_allocations(self, group_attribute_name: str, include_new: bool = False) -> list[dict]:
+                without_group += 1
+                if debug_enabled:
+                    logger.debug("  Project %s does not have group attribute defined.", project["title"])
+            yield project["title"], project["pi__username"], group_by_project.get(project["pk"], "")
+        logger.info(
+            "Found %d active projects: %d with group attribute, %d without.",
+            with_group + without_group,
+            with_group,
+            without_group,
+        )
+
+    def get_group_attribute_info_for_allocations(
+        self, group_attribute_name: str, include_new: bool = False
+    ) -> Iterator[tuple]:
+        """Yields a row of ALLOCATION_FIELDS values for each allocation."""
+        # pylint: disable=import-outside-toplevel
+        import coldfront.core.allocation.models as allocation_models
+
         logger.info("Getting group attribute info at the allocation level...")
-        info = []
         # get a list of allocations
         if include_new:
             allocations = allocation_models.Allocation.objects.filter(status__name__in=["Active", "New"])
         else:
             allocations = allocation_models.Allocation.objects.filter(status__name="Active")
-        logger.info("Found %d active allocations.", allocations.count())
-        for allocation in allocations:
-            # check if the current allocation has the group attribute defined
-            allocation_attributes = allocation.allocationattribute_set.filter(
-                allocation_attribute_type__name=group_attribute_name
+        allocation_ids = allocations.values("pk")
+        # map each allocation to its group attribute value and its first resource name in two narrow queries
+        group_by_allocation = {}
+        allocation_attributes = (
+            allocation_models.AllocationAttribute.objects.filter(
+                allocation__in=allocation_ids, allocation_attribute_type__name=group_attribute_name
             )
-            if allocation_attributes.exists():
-                logger.info("  Allocation %s:%s has group attribute defined.", 
-                            allocation.project.title, allocation.resources.first().name)
-                info.append(
-                    {
-                        "project": allocation.project.title,
-                        "pi_username": allocation.pi.username,
-                        "allocation": allocation.resources.first().name,
-                        "allocation_id": allocation.pk,
-                        "group": allocation_attributes.first().value,  # assuming only one per allocation
-                    }
-                )
-
+            .order_by("pk")
+            .values_list("allocation_id", "value")
+        )
+        for allocation_id, value in allocation_attributes.iterator(chunk_size=2000):
+            # assuming only one per allocation
+            group_by_allocation.setdefault(allocation_id, value)
+        resource_by_allocation = {}
+        allocation_resources = (
+            allocation_models.Allocation.resources.through.objects.filter(allocation__in=allocation_ids)
+            .order_by("resource__name")
+            .values_list("allocation_id", "resource__name")
+        )
+        for allocation_id, resource_name in allocation_resources.iterator(chunk_size=2000):
+            resource_by_allocation.setdefault(allocation_id, resource_name)
+
+        # only fetch the columns that are written out; no model instances are built
+        # per-row messages are DEBUG only; a summary is logged at INFO once the rows are written
+        debug_enabled = logger.isEnabledFor(logging.DEBUG)
+        with_group = without_group = 0
+        allocation_rows = allocations.values("pk", "project__title", "project__pi__username")
+        for allocation in allocation_rows.iterator(chunk_size=2000):
+            resource_name = resource_by_allocation.get(allocation["pk"], "")
+            # check if the current allocation has the group attribute defined
+            if allocation["pk"] in group_by_allocation:
+                with_group += 1
+                if debug_enabled:
+                    logger.debug(
+                        "  Allocation %s:%s has group attribute defined.", allocation["project__title"], resource_name
+                    )
             else:
-                logger.info(
-                    "  Allocation %s(%s) does not have group attribute defined.", 
-                    allocation.resources.first().name, allocation.pk
-                )
-                info.append(
-                    {
-                        "project": allocation.project.title,
-                        "pi_username": allocation.pi.username,
-                        "allocation": allocation.resources.first().name,
-                        "allocation_id": allocation.pk,
-                        "group": "",
-                    }
-                )
-        return info
+                without_group += 1
+                if debug_enabled:
+                    logger.debug(
+                        "  Allocation %s(%s) does not have group attribute defined.", resource_name, allocation["pk"]
+                    )
+            yield (
+                allocation["project__title"],
+                allocation["project__pi__username"],
+                resource_name,
+                allocation["pk"],
+                group_by_allocation.get(allocation["pk"], ""),
+            )
+        logger.info(
+            "Found %d active allocations: %d with group attribute, %d without.",
+            with_group + without_group,
+            with_group,
+            without_group,
+        )
 
     def handle(self, *args, **options):
+        # read the plugin settings once and pass them down
+        group_attribute_name = settings.UNIX_GROUP_ATTRIBUTE_NAME
+        manage_groups_at_project_level = settings.MANAGE_GROUPS_AT_PROJECT_LEVEL
+
         output_file = options.get("output_file")
         if not output_file:
             logger.error("Output file is required.")
             return
-        # check if output file is writable/valid path
-        if not os.access(os.path.dirname(output_file), os.W_OK):
-            logger.error("Output file is not writable.")
+        # fail on an unsupported format or an unwritable output file before doing any database work
+        output_format = self.resolve_output_format(output_file, options.get("format"))
+        try:
+            with open(output_file, mode="w", encoding="utf-8"):
+                pass
+        except OSError as e:
+            logger.error("Output file is not writable: %s", e)
+            return
 
         # determine whether to get attributes at the project or allocation level
-        alignment = self.parse_alignment(options.get("alignment"))
+        alignment = self.parse_alignment(options.get("alignment"), manage_groups_at_project_level)
         include_new = options.get("include_new", False)
-        # initialize differences tracking
-        info = []
-
         # processes a list of groups mapped to projects or allocations
         # determine whether to set attributes at the project or allocation level
-        group_attribute_name = settings.UNIX_GROUP_ATTRIBUTE_NAME
         if alignment == "project":
             logger.info("Getting group attribute info at the project level...")
+            fieldnames = PROJECT_FIELDS
             info = self.get_group_attribute_info_for_projects(group_attribute_name, include_new)
 
         else:
             logger.info("Getting group attribute info at the allocation level...")
+            fieldnames = ALLOCATION_FIELDS
             info = self.get_group_attribute_info_for_allocations(group_attribute_name, include_new)
 
         # write differences to output file
-        self.handle_output(info, output_file, options.get("format"))
+        self.handle_output(fieldnames, info, output_file, output_format)
         logger.info("Group attribute info gathering complete.")
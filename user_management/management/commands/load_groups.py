@@ -1,4 +1,5 @@
 import csv
+import functools
 import json
 import logging
 import os
@@ -7,9 +8,30 @@ import coldfront.core.allocation.models as allocation_models
 import coldfront.core.project.models as project_models
 from django.conf import settings
 from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Prefetch
+from django.utils import timezone
+from simple_history.utils import bulk_create_with_history, bulk_update_with_history
 
 logger = logging.getLogger(__name__)
 
+# columns read from each input row, in the order __parse_input_data unpacks them
+INPUT_FIELDS = ("project", "pi_username", "allocation_id", "group")
+CHANGE_TYPES = ("added", "updated", "skipped")
+DIFFERENCE_FIELDS = (
+    "mapping_key",
+    "project",
+    "project_pi",
+    "allocation",
+    "allocation_id",
+    "old_value",
+    "new_value",
+    "value",
+    "group",
+    "new_group",
+    "action",
+)
+
 
 class Command(BaseCommand):
     help = "Associate groups with projects or allocations"
@@ -17,6 +39,9 @@ class Command(BaseCommand):
     def __init__(self):
         super().__init__()
         self.differences = {}  # to track changes made
+        self.difference_counts = {}
+        self.processed_keys = set()  # input keys the setters have handled
+        self.differences_writer = None  # set when differences are streamed to a csv output file
 
     def add_arguments(self, parser):
         parser.add_argument(
@@ -26,7 +51,9 @@ class Command(BaseCommand):
             choices=["project", "allocation"],
             required=False,
         )
-        parser.add_argument("-n", "--include-new", help="Include 'New' projects or allocations", action="store_true", default=False)
+        parser.add_argument(
+            "-n", "--include-new", help="Include 'New' projects or allocations", action="store_true", default=False
+        )
         parser.add_argument("-i", "--input-file", help="Path to input file containing group mappings", required=True)
         parser.add_argument("-o", "--output-file", help="Path to output file for saving group updates", required=True)
         parser.add_argument(
@@ -38,8 +65,16 @@ class Command(BaseCommand):
         Process the input file and return a dictionary of group mappings.
         The input file should be a CSV with two columns: 'name' and 'group'.
         """
-        with open(input_file, mode="r", encoding="utf-8") as file:
-            rows = csv.DictReader(file)
+        with open(input_file, mode="r", encoding="utf-8", newline="") as file:
+            reader = csv.reader(file)
+            header = next(reader, [])
+            # resolve column positions once; absent columns read as None like DictReader's restval
+            columns = [header.index(name) if name in header else None for name in INPUT_FIELDS]
+            rows = (
+                tuple(row[i] if i is not None and i < len(row) else None for i in columns)
+                for row in reader
+                if row  # DictReader skips blank lines as well
+            )
             return self.__parse_input_data(rows)
 
     def process_json_input_file(self, input_file):
@@ -49,28 +84,27 @@ class Command(BaseCommand):
         """
         with open(input_file, mode="r", encoding="utf-8") as file:
             data = json.load(file)
-            return self.__parse_input_data(data)
+            return self.__parse_input_data(tuple(row.get(name) for name in INPUT_FIELDS) for row in data)
 
     @staticmethod
     def __parse_input_data(rows):
         """
         Parse input data rows into a dictionary of group mappings.
-        Each row should contain 'name', optional 'pi_username', and 'group'.
+        Each row is a tuple of INPUT_FIELDS values: 'project', optional 'pi_username', 'allocation_id' and 'group'.
         """
         group_mappings = {}
         for row in rows:
-            project = row.get("project")
-            pi_username = row.get("pi_username")
-            allocation_id = row.get("allocation_id")
-            group = row.get("group")
+            project, pi_username, allocation_id, group = row
 
-            if group is None or group.strip() == "":
+            # None and whitespace-only values are both treated as missing
+            if not group or group.isspace():
                 logger.warning("Skipping row with empty group: %s", row)
                 continue
-            
-            if allocation_id is not None and allocation_id.strip() != "":
-                group_mappings[allocation_id.strip()] = group
-            elif (project is not None and project.strip() != "") and (pi_username is not None and pi_username.strip() != ""):
+
+            allocation_id = allocation_id.strip() if allocation_id else ""
+            if allocation_id:
+                group_mappings[allocation_id] = group
+            elif project and not project.isspace() and pi_username and not pi_username.isspace():
                 group_mappings[f"{project}_{pi_username}".lower().strip()] = group
             else:
                 logger.warning("Skipping invalid row: %s", row)
@@ -80,8 +114,9 @@ class Command(BaseCommand):
         # check if the ProjectAttributeType exists
         project_attribute_type, created = project_models.ProjectAttributeType.objects.get_or_create(
             name=group_attribute_name,
+            # a callable default is only evaluated when the type has to be created
             defaults={
-                "attribute_type": project_models.AttributeType.objects.get(name="Text"),
+                "attribute_type": functools.partial(project_models.AttributeType.objects.get, name="Text"),
                 "has_usage": False,
                 "is_required": False,
                 "is_unique": False,
@@ -98,82 +133,132 @@ class Command(BaseCommand):
     def set_group_attribute_for_projects(self, project_attribute_type, group_mappings, include_new, dry_run):
         logger.info("Setting group attribute at the project level...")
         # get a list of projects
-        projects = None
-        if include_new:
-            projects = project_models.Project.objects.filter(status__name__in=["Active", "New"])
-        else:
-            projects = project_models.Project.objects.filter(status__name="Active")
-        logger.info("Found %d active projects.", projects.count())
-        for project in projects:
-            # get the group for the current project from the input file
-            group_for_project = group_mappings.get(f"{project.title}_{project.pi.username}".lower().strip())
-            if not group_for_project:
-                logger.info("    No group mapping found for project %s in input file. Skipping.", project.title)
+        status_names = ["Active", "New"] if include_new else ["Active"]
+        # match projects to input rows on just their id, title and PI; the key is built in Python exactly like
+        # the input rows' keys, since SQL LOWER and TRIM don't fold non-ASCII capitals or strip tabs and newlines
+        key_by_pk = {}
+        project_rows = project_models.Project.objects.filter(status__name__in=status_names).values_list(
+            "pk", "title", "pi__username"
+        )
+        for pk, title, pi_username in project_rows.iterator(chunk_size=2000):
+            mapping_key = f"{title}_{pi_username}".lower().strip()
+            if mapping_key in group_mappings:
+                key_by_pk[pk] = mapping_key
+        projects = project_models.Project.objects.filter(pk__in=list(key_by_pk))
+        # load the PI and the existing group attribute for every project up front instead of querying per project
+        projects = (
+            projects.select_related("pi")
+            .only("title", "pi__username")
+            .prefetch_related(
+                Prefetch(
+                    "projectattribute_set",
+                    queryset=project_models.ProjectAttribute.objects.filter(proj_attr_type=project_attribute_type),
+                    to_attr="group_attributes",
+                )
+            )
+        )
+        # index projects by mapping key so each input row is a dict lookup
+        projects_by_key = {key_by_pk[project.pk]: project for project in projects.iterator(chunk_size=2000)}
+        logger.info("Found %d active projects in input file.", len(projects_by_key))
+        # per-row messages are DEBUG only; counts are logged at INFO once the rows are written
+        # changed and new attributes are written together once every row has been checked
+        attributes_to_update = []
+        attributes_to_create = []
+        for mapping_key, group_for_project in group_mappings.items():
+            self.processed_keys.add(mapping_key)
+            project = projects_by_key.get(mapping_key)
+            if project is None:
+                logger.debug("    No active project found for %s in input file. Skipping.", mapping_key)
+                self.record_difference("skipped", {"mapping_key": mapping_key, "group": group_for_project})
                 continue
 
             # check if the current project has the group attribute defined
-            project_attributes = project.projectattribute_set.filter(proj_attr_type=project_attribute_type)
+            # assuming only one attribute of this type per project
+            existing_attribute = project.group_attributes[0] if project.group_attributes else None
             # todo: check if the AttributeType name is a unique value
-            if project_attributes.exists():
-                logger.info("  Project %s has group attribute defined.", project.title)
+            if existing_attribute is not None:
+                logger.debug("  Project %s has group attribute defined.", project.title)
                 # update if different than passed value, otherwise do nothing
                 # todo: should have an option to not overwrite existing values
-                if project_attributes.first().value == group_for_project:
-                    logger.info("    Group attribute already set to %s. Skipping.", group_for_project)
-                    self.differences["skipped"].append(
+                if existing_attribute.value == group_for_project:
+                    logger.debug("    Group attribute already set to %s. Skipping.", group_for_project)
+                    self.record_difference(
+                        "skipped",
                         {
-                            "mapping_key": f"{project.title}_{project.pi.username}".lower().strip(),
+                            "mapping_key": mapping_key,
                             "project": project.title,
                             "project_pi": project.pi.username,
                             "group": group_for_project,
                             "new_group": group_for_project,
-                        }
+                        },
                     )
                     continue
-                if not dry_run:
-                    project_attributes.first().update(value=group_for_project)
-                    logger.info("    Updated group attribute to %s for project %s.", group_for_project, project.title)
                 # log changes
-                self.differences["updated"].append(
+                self.record_difference(
+                    "updated",
                     {
-                        "mapping_key": f"{project.title}_{project.pi.username}".lower().strip(),
+                        "mapping_key": mapping_key,
                         "project": project.title,
                         "project_pi": project.pi.username,
-                        "group": project_attributes.first().value,  # assuming only one attribute of this type per project
+                        "group": existing_attribute.value,
                         "new_group": group_for_project,
-                    }
+                    },
                 )
+                if not dry_run:
+                    existing_attribute.value = group_for_project
+                    existing_attribute.modified = timezone.now()
+                    attributes_to_update.append(existing_attribute)
+                    logger.debug("    Updating group attribute to %s for project %s.", group_for_project, project.title)
             else:
-                logger.info("  Project %s does not have group attribute defined.", project.title)
+                logger.debug("  Project %s does not have group attribute defined.", project.title)
 
+                self.record_difference(
+                    "added",
+                    {
+                        "mapping_key": mapping_key,
+                        "project": project.title,
+                        "project_pi": project.pi.username,
+                        "group": "",
+                        "new_group": group_for_project,
+                    },
+                )
                 if not dry_run:
                     # create the ProjectAttribute with the value from passed argument
-                    pa = project_models.ProjectAttribute(
-                        project=project, proj_attr_type=project_attribute_type, value=group_for_project
+                    attributes_to_create.append(
+                        project_models.ProjectAttribute(
+                            project=project, proj_attr_type=project_attribute_type, value=group_for_project
+                        )
                     )
-                    pa.save()
-                    logger.info(
-                        "    Created group attribute %s=%s for project %s.",
+                    logger.debug(
+                        "    Creating group attribute %s=%s for project %s.",
                         project_attribute_type.name,
                         group_for_project,
                         project.title,
                     )
-                    self.differences["added"].append(
-                        {
-                            "mapping_key": f"{project.title}_{project.pi.username}".lower().strip(),
-                            "project": project.title,
-                            "project_pi": project.pi.username,
-                            "group": "",
-                            "new_group": group_for_project,
-                        }
-                    )
+        if attributes_to_update:
+            # bulk_update skips save(), so the modified timestamp is set above and written with the value
+            updated = bulk_update_with_history(
+                attributes_to_update, project_models.ProjectAttribute, ["value", "modified"], batch_size=500
+            )
+            logger.info("Updated %d project group attributes.", updated)
+        if attributes_to_create:
+            # bulk_create skips save(), so record history and usage the same way save() would
+            created = bulk_create_with_history(attributes_to_create, project_models.ProjectAttribute, batch_size=500)
+            if project_attribute_type.has_usage:
+                bulk_create_with_history(
+                    [project_models.ProjectAttributeUsage(project_attribute=pa) for pa in created],
+                    project_models.ProjectAttributeUsage,
+                    batch_size=500,
+                )
+            logger.info("Created %d project group attributes.", len(created))
 
     def get_allocation_attribute_type(self, group_attribute_name, dry_run):
         # check if the AllocationAttributeType exists
         allocation_attribute_type, created = allocation_models.AllocationAttributeType.objects.get_or_create(
             name=group_attribute_name,
+            # a callable default is only evaluated when the type has to be created
             defaults={
-                "attribute_type": allocation_models.AttributeType.objects.get(name="Text"),
+                "attribute_type": functools.partial(allocation_models.AttributeType.objects.get, name="Text"),
                 "has_usage": False,
                 "is_required": False,
                 "is_unique": False,
@@ -189,78 +274,126 @@ class Command(BaseCommand):
 
     def set_group_attribute_for_allocations(self, allocation_attribute_type, group_mappings, include_new, dry_run):
         # get a list of allocations
-        allocations = None
-        if include_new:
-            allocations = allocation_models.Allocation.objects.filter(status__name__in=["Active", "New"])
-        else:
-            allocations = allocation_models.Allocation.objects.filter(status__name="Active")
-        logger.info("Found %d active allocations.", allocations.count())
-        for allocation in allocations:
+        status_names = ["Active", "New"] if include_new else ["Active"]
+        # allocation mappings are keyed by allocation id; only fetch allocations named in the input file
+        allocation_ids = [key for key in group_mappings if key.isdigit()]
+        allocations = allocation_models.Allocation.objects.filter(status__name__in=status_names, pk__in=allocation_ids)
+        # load the project, PI, resources and existing group attribute for every allocation up front
+        allocations = (
+            allocations.select_related("project__pi")
+            .only("project__title", "project__pi__username")
+            .prefetch_related(
+                "resources",
+                Prefetch(
+                    "allocationattribute_set",
+                    queryset=allocation_models.AllocationAttribute.objects.filter(
+                        allocation_attribute_type=allocation_attribute_type
+                    ),
+                    to_attr="group_attributes",
+                ),
+            )
+        )
+        # changed and new attributes are written together once every row has been checked
+        attributes_to_update = []
+        attributes_to_create = []
+        # stream allocations in chunks and count them as they go instead of a separate COUNT query
+        allocation_count = 0
+        # per-row messages are DEBUG only; counts are logged at INFO once the rows are written
+        for allocation in allocations.iterator(chunk_size=2000):
+            allocation_count += 1
+            # allocation rows are keyed by allocation id in the input file
+            self.processed_keys.add(str(allocation.pk))
             # get the group for the current allocation from the input file
             group_for_allocation = group_mappings.get(str(allocation.pk))
+            # resources are ordered by name, so this matches resources.first() without another query
+            resource = next(iter(allocation.resources.all()), None)
+            resource_name = resource.name if resource else ""
+            mapping_key = f"{allocation.project.title}_{allocation.project.pi.username}".lower().strip()
             # check if the current allocation has the group attribute defined
-            allocation_attributes = allocation.allocationattribute_set.filter(
-                allocation_attribute_type=allocation_attribute_type
-            )
-            if allocation_attributes.exists():
-                logger.info("  Allocation %s has group attribute defined.", allocation.project.title)
+            # assuming only one attribute of this type per allocation
+            existing_attribute = allocation.group_attributes[0] if allocation.group_attributes else None
+            if existing_attribute is not None:
+                logger.debug("  Allocation %s has group attribute defined.", allocation.project.title)
                 # update if different than passed value, otherwise do nothing
-                if allocation_attributes.first().value == group_for_allocation:
-                    logger.info("    Group attribute already set to %s. Skipping.", group_for_allocation)
-                    self.differences["skipped"].append(
+                if existing_attribute.value == group_for_allocation:
+                    logger.debug("    Group attribute already set to %s. Skipping.", group_for_allocation)
+                    self.record_difference(
+                        "skipped",
                         {
-                            "mapping_key": f"{allocation.project.title}_{allocation.pi.username}".lower().strip(),
-                            "allocation": allocation.resources.first().name,
+                            "mapping_key": mapping_key,
+                            "allocation": resource_name,
                             "allocation_id": allocation.pk,
                             "group": group_for_allocation,
                             "new_group": group_for_allocation,
-                        }
+                        },
                     )
                     continue
+                # log changes
+                self.record_difference(
+                    "updated",
+                    {
+                        "mapping_key": mapping_key,
+                        "allocation": resource_name,
+                        "allocation_id": allocation.pk,
+                        "group": existing_attribute.value,
+                        "new_group": group_for_allocation,
+                    },
+                )
                 if not dry_run:
-                    allocation_attributes.first().update(value=group_for_allocation)
-                    logger.info(
-                        "    Updated group attribute to %s for allocation %s.",
+                    existing_attribute.value = group_for_allocation
+                    existing_attribute.modified = timezone.now()
+                    attributes_to_update.append(existing_attribute)
+                    logger.debug(
+                        "    Updating group attribute to %s for allocation %s.",
                         group_for_allocation,
                         allocation.project.title,
                     )
-                    # log changes
-                    self.differences["updated"].append(
-                        {
-                            "mapping_key": f"{allocation.project.title}_{allocation.pi.username}".lower().strip(),
-                            "allocation": allocation.resources.first().name,
-                            "allocation_id": allocation.pk,
-                            "group": allocation_attributes.first().value,
-                            "new_group": group_for_allocation,
-                        }
-                    )
             else:
-                logger.info(
-                    "  Allocation %s(%s) does not have group attribute defined.", allocation.resources.first().name, allocation.pk
+                logger.debug("  Allocation %s(%s) does not have group attribute defined.", resource_name, allocation.pk)
+                self.record_difference(
+                    "added",
+                    {
+                        "mapping_key": mapping_key,
+                        "allocation": resource_name,
+                        "allocation_id": allocation.pk,
+                        "group": "",
+                        "new_group": group_for_allocation,
+                    },
                 )
                 if not dry_run:
                     # create the AllocationAttribute with the value from passed argument
-                    aa = allocation_models.AllocationAttribute(
-                        allocation=allocation,
-                        allocation_attribute_type=allocation_attribute_type,
-                        value=group_for_allocation,
+                    attributes_to_create.append(
+                        allocation_models.AllocationAttribute(
+                            allocation=allocation,
+                            allocation_attribute_type=allocation_attribute_type,
+                            value=group_for_allocation,
+                        )
                     )
-                    aa.save()
-                    logger.info(
-                        "    Created group attribute %s=%s for allocation %s.",
+                    logger.debug(
+                        "    Creating group attribute %s=%s for allocation %s.",
                         allocation_attribute_type.name,
                         group_for_allocation,
-                        allocation.resource.name,
-                    )
-                    self.differences["added"].append(
-                        {
-                            "mapping_key": f"{allocation.project.title}_{allocation.pi.username}".lower().strip(),
-                            "allocation": allocation.resources.first().name,
-                            "allocation_id": allocation.pk,
-                            "group": "",
-                            "new_group": group_for_allocation,
-                        }
+                        resource_name,
                     )
+        logger.info("Checked %d active allocations in input file.", allocation_count)
+        if attributes_to_update:
+            # bulk_update skips save(), so the modified timestamp is set above and written with the value
+            updated = bulk_update_with_history(
+                attributes_to_update, allocation_models.AllocationAttribute, ["value", "modified"], batch_size=500
+            )
+            logger.info("Updated %d allocation group attributes.", updated)
+        if attributes_to_create:
+            # bulk_create skips save(), so record history and usage the same way save() would
+            created = bulk_create_with_history(
+                attributes_to_create, allocation_models.AllocationAttribute, batch_size=500
+            )
+            if allocation_attribute_type.has_usage:
+                bulk_create_with_history(
+                    [allocation_models.AllocationAttributeUsage(allocation_attribute=aa) for aa in created],
+                    allocation_models.AllocationAttributeUsage,
+                    batch_size=500,
+                )
+            logger.info("Created %d allocation group attributes.", len(created))
 
     def handle_input_file(self, input_file):
         if not input_file:
@@ -294,51 +427,57 @@ class Command(BaseCommand):
         logger.info("Setting group alignment at the '%s' level.", alignment)
         return alignment
 
+    def record_difference(self, change_type, change):
+        """
+        Records a change for the output file. CSV rows are written as soon as they are recorded;
+        JSON output groups changes by type, so those are kept until handle_differences writes them.
+        """
+        self.difference_counts[change_type] += 1
+        if self.differences_writer is not None:
+            self.differences_writer.writerow(change | {"action": change_type})
+        else:
+            self.differences[change_type].append(change)
+
     def handle_differences(self, group_mappings, output_file):
         # compare differences with group mappings from input file, add any missing entries to 'skipped'
-        input_keys = set(group_mappings.keys())
-        processed_keys = set()
-        for change_type in ["added", "updated", "skipped"]:
-            for change in self.differences[change_type]:
-                processed_keys.add(change["mapping_key"])
         # these input keys didn't match any existing projects/allocations
-        missing_keys = input_keys - processed_keys
-        for key in missing_keys:
-            self.differences["skipped"].append({"mapping_key": key, "group": group_mappings[key]})
-        logger.debug(
+        for key in group_mappings.keys() - self.processed_keys:
+            self.record_difference("skipped", {"mapping_key": key, "group": group_mappings[key]})
+        logger.info(
             "Processed %d changes: %d added, %d updated, %d skipped.",
-            len(self.differences["added"]) + len(self.differences["updated"]) + len(self.differences["skipped"]),
-            len(self.differences["added"]),
-            len(self.differences["updated"]),
-            len(self.differences["skipped"]),
+            sum(self.difference_counts.values()),
+            self.difference_counts["added"],
+            self.difference_counts["updated"],
+            self.difference_counts["skipped"],
         )
         # write differences to output file
-        if output_file.endswith(".csv"):
-            with open(output_file, mode="w", encoding="utf-8", newline="") as file:
-                fieldnames = [
-                    "mapping_key",
-                    "project",
-                    "project_pi",
-                    "allocation",
-                    "allocation_id",
-                    "old_value",
-                    "new_value",
-                    "value",
-                    "group",
-                    "action",
-                ]
-                writer = csv.DictWriter(file, fieldnames=fieldnames)
-                writer.writeheader()
-                for change_type in ["added", "updated", "skipped"]:
-                    for change in self.differences[change_type]:
-                        change["action"] = change_type
-                        writer.writerow(change)
-                logger.info("Wrote differences to output file %s.", output_file)
+        if self.differences_writer is not None:
+            logger.info("Wrote differences to output file %s.", output_file)
         elif output_file.endswith(".json"):
             with open(output_file, mode="w", encoding="utf-8") as file:
-                json.dump(self.differences, file, indent=4)
+                # a single compact dumps() call runs in the C encoder; json.dump and indent both fall back to pure Python
+                file.write(json.dumps(self.differences))
                 logger.info("Wrote differences to output file %s.", output_file)
 
+    def apply_group_mappings(self, alignment, group_mappings, include_new, dry_run):
+        # processes a list of groups mapped to projects or allocations
+        # determine whether to set attributes at the project or allocation level
+        group_attribute_name = settings.UNIX_GROUP_ATTRIBUTE_NAME
+        # commit all attribute type and attribute writes together, or none of them if the run fails
+        with transaction.atomic():
+            if alignment == "project":
+                logger.info("Setting group attribute at the project level...")
+                project_attribute_type = self.get_project_attribute_type(group_attribute_name, dry_run)
+                self.set_group_attribute_for_projects(project_attribute_type, group_mappings, include_new, dry_run)
+
+            else:
+                logger.info("Setting group attribute at the allocation level...")
+                allocation_attribute_type = self.get_allocation_attribute_type(group_attribute_name, dry_run)
+                self.set_group_attribute_for_allocations(
+                    allocation_attribute_type, group_mappings, include_new, dry_run
+                )
+        logger.info("Group attribute update process complete.")
+
     def handle(self, *args, **options):
         dry_run = options.get("dry_run", False)
         if dry_run:
@@ -346,7 +485,7 @@ class Command(BaseCommand):
 
         input_file = options.get("input_file")
         group_mappings = self.handle_input_file(input_file)
-        
+
         output_file = options.get("output_file")
         if not output_file:
             logger.error("Output file is required.")
@@ -360,21 +499,19 @@ class Command(BaseCommand):
         include_new = options.get("include_new", False)
 
         # initialize differences tracking
-        self.differences = {"added": [], "updated": [], "skipped": []}  # to track changes made
-
-        # processes a list of groups mapped to projects or allocations
-        # determine whether to set attributes at the project or allocation level
-        group_attribute_name = settings.UNIX_GROUP_ATTRIBUTE_NAME
-        if alignment == "project":
-            logger.info("Setting group attribute at the project level...")
-            project_attribute_type = self.get_project_attribute_type(group_attribute_name, dry_run)
-            self.set_group_attribute_for_projects(project_attribute_type, group_mappings, include_new, dry_run)
-
+        self.differences = {change_type: [] for change_type in CHANGE_TYPES}  # to track changes made
+        self.difference_counts = dict.fromkeys(CHANGE_TYPES, 0)
+        self.processed_keys = set()
+        self.differences_writer = None
 
+        if output_file.endswith(".csv"):
+            # stream rows to the csv file while the mappings are applied instead of collecting them first
+            with open(output_file, mode="w", encoding="utf-8", newline="") as file:
+                self.differences_writer = csv.DictWriter(file, fieldnames=DIFFERENCE_FIELDS)
+                self.differences_writer.writeheader()
+                self.apply_group_mappings(alignment, group_mappings, include_new, dry_run)
+                self.handle_differences(group_mappings, output_file)
+            self.differences_writer = None
         else:
-            logger.info("Setting group attribute at the allocation level...")
-            allocation_attribute_type = self.get_allocation_attribute_type(group_attribute_name, dry_run)
-            self.set_group_attribute_for_allocations(allocation_attribute_type, group_mappings, include_new, dry_run)
-        logger.info("Group attribute update process complete.")
-
-        self.handle_differences(group_mappings, output_file)
+            self.apply_group_mappings(alignment, group_mappings, include_new, dry_run)
+            self.handle_differences(group_mappings, output_file)
@@ -1,12 +1,26 @@
 import logging
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
+from coldfront.core.allocation.models import (
+    Allocation,
+    AllocationAttribute,
+    AllocationUser,
+    AllocationUserStatusChoice,
+)
+from coldfront.core.project.models import (
+    Project,
+    ProjectAttribute,
+    ProjectUser,
+    ProjectUserRoleChoice,
+    ProjectUserStatusChoice,
+)
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.management.base import BaseCommand
+from django.db.models import Prefetch
 from django_auth_ldap.backend import LDAPBackend
-
-from coldfront.core.allocation.models import Allocation, AllocationUser
-from coldfront.core.project.models import Project, ProjectUser, ProjectUserRoleChoice, ProjectUserStatusChoice
+from simple_history.utils import bulk_create_with_history, bulk_update_with_history
 
 from user_management import utils
 
@@ -18,17 +32,21 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument("-t", "--sync-to", help="Sync changes to external system", action="store_true")
-        parser.add_argument("-n", "--include-new", help="Include 'New' projects or allocations", action="store_true", default=False)
+        parser.add_argument(
+            "-n", "--include-new", help="Include 'New' projects or allocations", action="store_true", default=False
+        )
         parser.add_argument("-u", "--username", help="Check specific username")
         parser.add_argument("-g", "--group", help="Check specific group")
         parser.add_argument(
             "-d", "--dry-run", help="Only show differences. Do not run any commands.", action="store_true"
         )
-        #parser.add_argument("-x", "--no-header", help="Exclude header from output", action="store_true")
-        #parser.add_argument("-f", "--format", help="json or csv output", default=None)
-        #parser.add_argument("-o", "--output-file", help="Path to output file for saving group updates", required=True)
+        # parser.add_argument("-x", "--no-header", help="Exclude header from output", action="store_true")
+        # parser.add_argument("-f", "--format", help="json or csv output", default=None)
+        # parser.add_argument("-o", "--output-file", help="Path to output file for saving group updates", required=True)
 
-    def collate_project_user_data(self, group_attribute_name, include_new, group_specified=None):
+    def collate_project_user_data(
+        self, group_attribute_name, include_new, group_specified=None, username_specified=None
+    ):
         coldfront_project_users = []
         # get project users mapped to groups and projects
         projects_with_groups = None
@@ -36,17 +54,36 @@ class Command(BaseCommand):
             projects_with_groups = Project.objects.filter(
                 status__name__in=["Active", "New"], projectattribute__proj_attr_type__name=group_attribute_name
             ).distinct()
-        else:   
+        else:
             projects_with_groups = Project.objects.filter(
                 status__name="Active", projectattribute__proj_attr_type__name=group_attribute_name
             ).distinct()
+        # only the specified user's membership is loaded when filtering to a username
+        active_users = ProjectUser.objects.filter(status__name="Active").select_related("user")
+        if username_specified:
+            active_users = active_users.filter(user__username=username_specified)
+        # load the PI, group attributes and active users of every project up front instead of querying per project
+        projects_with_groups = projects_with_groups.select_related("pi").prefetch_related(
+            Prefetch(
+                "projectattribute_set",
+                queryset=ProjectAttribute.objects.filter(proj_attr_type__name=group_attribute_name),
+                to_attr="group_attributes",
+            ),
+            Prefetch(
+                "projectuser_set",
+                queryset=active_users,
+                to_attr="active_users",
+            ),
+        )
 
-        self.stdout.write("Found %d projects with groups." % projects_with_groups.count())
-        for project in projects_with_groups:
+        # stream the projects in chunks, each with its own prefetch queries, and count them as they go
+        project_count = 0
+        for project in projects_with_groups.iterator(chunk_size=2000):
+            project_count += 1
             self.stdout.write("Processing project %s (ID: %s)..." % (project.title, project.pk))
-            project_info = {"project": project.title, "project_id": project.pk, "groups": [], "users": []}
+            project_info = {"project": project.title, "project_id": project.pk, "groups": [], "users": frozenset()}
             # get groups from project attributes
-            groups = utils.get_project_attribute_values_set(project, group_attribute_name)
+            groups = {attribute.value for attribute in project.group_attributes}
             if group_specified and group_specified not in groups:
                 logger.debug(
                     "  Skipping project %s due to group filter. Group '%s' not in project groups %s.",
@@ -60,106 +97,157 @@ class Command(BaseCommand):
                 continue
             logger.debug("    Groups from project attribute '%s': %s", group_attribute_name, groups)
             project_info["groups"] = list(groups)
-            # get active project users
-            project_users = ProjectUser.objects.filter(project=project, status__name="Active").select_related("user")
-            project_info["users"] = list(project_users.values_list("user__username", flat=True))
-
+            # get active project users and the PI, as a frozenset so compare_coldfront_to_external can diff it directly
             logger.debug("  Project PI: %s (ID: %s)", project.pi.username, project.pi.pk)
-            project_info["users"].append(project.pi.username)
+            users = [project_user.user.username for project_user in project.active_users] + [project.pi.username]
+            if username_specified:
+                users = [user for user in users if user == username_specified]
+            project_info["users"] = frozenset(users)
             coldfront_project_users.append(project_info)
+        self.stdout.write("Found %d projects with groups." % project_count)
         return coldfront_project_users
 
-    def collate_allocation_user_data(self, group_attribute_name, include_new, group_specified=None):
+    def collate_allocation_user_data(
+        self, group_attribute_name, include_new, group_specified=None, username_specified=None
+    ):
         coldfront_allocation_users = []
         # get project users mapped to groups and projects
         allocations_with_groups = None
         if include_new:
             allocations_with_groups = Allocation.objects.filter(
-                status__name__in=["Active", "New"], allocationattribute__allocation_attribute_type__name=group_attribute_name
+                status__name__in=["Active", "New"],
+                allocationattribute__allocation_attribute_type__name=group_attribute_name,
             ).distinct()
         else:
             allocations_with_groups = Allocation.objects.filter(
                 status__name="Active", allocationattribute__allocation_attribute_type__name=group_attribute_name
             ).distinct()
-        self.stdout.write("Found %d allocations with groups." % allocations_with_groups.count())
-        for allocation in allocations_with_groups:
-            self.stdout.write("Processing allocation %s (ID: %s)..." % (allocation.resources.first().name, allocation.pk))
+        # only the specified user's membership is loaded when filtering to a username
+        active_users = AllocationUser.objects.filter(status__name="Active").select_related("user")
+        if username_specified:
+            active_users = active_users.filter(user__username=username_specified)
+        # load the resources, group attributes and active users of every allocation up front
+        allocations_with_groups = allocations_with_groups.prefetch_related(
+            "resources",
+            Prefetch(
+                "allocationattribute_set",
+                queryset=AllocationAttribute.objects.filter(allocation_attribute_type__name=group_attribute_name),
+                to_attr="group_attributes",
+            ),
+            Prefetch(
+                "allocationuser_set",
+                queryset=active_users,
+                to_attr="active_users",
+            ),
+        )
+        # stream the allocations in chunks, each with its own prefetch queries, and count them as they go
+        allocation_count = 0
+        for allocation in allocations_with_groups.iterator(chunk_size=2000):
+            allocation_count += 1
+            # resources are ordered by name, so this matches resources.first() without another query
+            resource = next(iter(allocation.resources.all()), None)
+            resource_name = resource.name if resource else ""
+            self.stdout.write("Processing allocation %s (ID: %s)..." % (resource_name, allocation.pk))
             allocation_info = {
-                "allocation": allocation.resources.first().name,
+                "allocation": resource_name,
                 "allocation_id": allocation.pk,
                 "groups": [],
-                "users": [],
+                "users": frozenset(),
             }
             # get groups from project attributes
-            groups = set(allocation.get_attribute_list(group_attribute_name))
+            groups = {attribute.value for attribute in allocation.group_attributes}
             if group_specified and group_specified not in groups:
                 logger.debug(
                     "  Skipping allocation %s(%s) due to group filter. Group '%s' not in allocation groups %s.",
-                    allocation.resources.first().name,
+                    resource_name,
                     allocation.pk,
                     group_specified,
                     groups,
                 )
                 continue
             if len(groups) == 0:
-                logger.debug("    Allocation %s(%s) does not have any groups. Nothing to add or remove.", 
-                             allocation.resources.first().name, allocation.pk)
+                logger.debug(
+                    "    Allocation %s(%s) does not have any groups. Nothing to add or remove.",
+                    resource_name,
+                    allocation.pk,
+                )
                 continue
             logger.debug("    Groups from project attribute '%s': %s", group_attribute_name, groups)
             allocation_info["groups"] = list(groups)
 
-            # get active project users
-            allocation_users = AllocationUser.objects.filter(
-                allocation=allocation, status__name="Active"
-            ).select_related("user")
-            allocation_info["users"] = list(allocation_users.values_list("user__username", flat=True))
+            # get active allocation users, as a frozenset so compare_coldfront_to_external can diff it directly
+            allocation_info["users"] = frozenset(
+                allocation_user.user.username for allocation_user in allocation.active_users
+            )
 
             coldfront_allocation_users.append(allocation_info)
-            return coldfront_allocation_users
+        self.stdout.write("Found %d allocations with groups." % allocation_count)
+        return coldfront_allocation_users
 
-    def collate_external_user_data(self, group_set):
-        client = utils.get_client()
+    def collate_external_user_data(self, group_set, client):
         external_users_and_groups = []
-        for group in group_set:
-            errors = []
-            self.stdout.write("Querying external system for members of group %s..." % group)
-            try:
-                if client.group_exists(group):
-                    members = client.get_group_members(group)
-                else:
+        if not group_set:
+            return external_users_and_groups
+
+        def query_group(group):
+            if not client.group_exists(group):
+                return [], [f"Group {group} does not exist in external system."]
+            return client.get_group_members(group), []
+
+        # each group is a blocking round trip to the external system, so several are queried at once
+        max_workers = min(getattr(settings, "USER_MANAGEMENT_SYNC_CONCURRENCY", 8), len(group_set))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {}
+            for group in group_set:
+                self.stdout.write("Querying external system for members of group %s..." % group)
+                futures[executor.submit(query_group, group)] = group
+            for future in as_completed(futures):
+                group = futures[future]
+                try:
+                    members, errors = future.result()
+                except Exception as e:
+                    self.stderr.write("Failed to get members of group %s: %s" % (group, e))
+                    continue
+                if errors:
                     self.stdout.write("Group %s does not exist in external system." % group)
-                    errors.append(f"Group {group} does not exist in external system.")
-                    members = []
-            except Exception as e:
-                self.stderr.write("Failed to get members of group %s: %s" % (group, e))
-                errors.append(f"Failed to get members of group {group}: {e}")
-                continue
-            external_users_and_groups.append({"group": group, "members": members, "errors": errors})
+                external_users_and_groups.append({"group": group, "members": members, "errors": errors})
         return external_users_and_groups
 
-    def compare_coldfront_to_external(self, coldfront_users_and_groups, external_users_and_groups):
+    def compare_coldfront_to_external(
+        self, coldfront_users_and_groups, external_users_and_groups, username_specified=None
+    ):
         differences = []
-        external_group_dict = {g["group"]: set(g["members"]) for g in external_users_and_groups}
+        external_group_dict = {g["group"]: frozenset(g["members"]) for g in external_users_and_groups}
+        external_errors = {g["group"]: g.get("errors", []) for g in external_users_and_groups}
         if settings.MANAGE_GROUPS_AT_PROJECT_LEVEL:
             alignment = "project"
-        else:            
+        else:
             alignment = "allocation"
         for entry in coldfront_users_and_groups:
             groups = entry["groups"]
-            users = set(entry["users"])
+            # collated users are already a frozenset
+            users = entry["users"]
             for group in groups:
-                external_members = external_group_dict.get(group, set())
+                external_members = external_group_dict.get(group, frozenset())
+                # groups that are in sync are the common case; set equality checks the sizes first
+                if users == external_members:
+                    continue
                 missing_from_external = users - external_members
                 missing_from_coldfront = external_members - users
+                if username_specified:
+                    # only the specified user is synced
+                    missing_from_external &= {username_specified}
+                    missing_from_coldfront &= {username_specified}
                 if missing_from_external or missing_from_coldfront:
                     differences.append(
                         {
                             "alignment": alignment,
+                            alignment: entry[alignment],
                             f"{alignment}_id": entry[f"{alignment}_id"],
                             "group": group,
                             "missing_from_external": list(missing_from_external),
                             "missing_from_coldfront": list(missing_from_coldfront),
-                            "errors": [i for e in external_users_and_groups if e["group"] == group and "errors" in e for i in e['errors']],
+                            "errors": list(external_errors.get(group, [])),
                         }
                     )
                     logger.debug(
@@ -169,132 +257,218 @@ class Command(BaseCommand):
                         len(missing_from_coldfront),
                     )
         return differences
-    
-    def sync_to_external(self, diff, username_specified=None):
-        client = utils.get_client()
+
+    def sync_to_external(self, diff, client):
+        # messages are collected and written once per difference instead of once per user
+        lines = []
         for user in diff["missing_from_external"]:
-            if username_specified and user != username_specified:
-                logger.debug("  Skipping add of user %s due to username filter.", user)
-                continue
-            self.stdout.write("Adding user %s to group %s..." % (user, diff["group"]))
+            lines.append("Adding user %s to group %s..." % (user, diff["group"]))
             try:
                 client.add_user_to_group(user, diff["group"])
             except IOError as e:
-                self.stdout.write("Failed to add user %s to group %s: %s" % (user, diff["group"], e))
+                lines.append("Failed to add user %s to group %s: %s" % (user, diff["group"], e))
         for user in diff["missing_from_coldfront"]:
-            if username_specified and user != username_specified:
-                logger.debug("  Skipping remove of user %s due to username filter.", user)
-                continue
-            self.stdout.write("Removing user %s from group %s..." % (user, diff["group"]))
+            lines.append("Removing user %s from group %s..." % (user, diff["group"]))
             try:
                 client.remove_user_from_group(user, diff["group"])
             except IOError as e:
-                self.stdout.write("Failed to remove user %s from group %s: %s" % (user, diff["group"], e))
+                lines.append("Failed to remove user %s from group %s: %s" % (user, diff["group"], e))
+        if lines:
+            self.stdout.write("\n".join(lines))
 
-    def sync_to_coldfront_projects(self, diff, username_specified=None):
-        if diff.get("errors", []):
-            logger.warning(
-                "Skipping sync for group %s due to errors: %s", diff["group"], "; ".join(diff["errors"])
-            )
-            self.stdout.write("Skipping sync for group %s due to errors: %s" % (diff["group"], "; ".join(diff["errors"])))
-            return
-        # get the Project object
-        p = Project.objects.get(pk=diff["project_id"])
-        project_allocations = Allocation.objects.filter(project=p)
-        active_status = ProjectUserStatusChoice.objects.get(name="Active")
-        user_role = ProjectUserRoleChoice.objects.get(name="User")
-        
-        for user in diff["missing_from_coldfront"]:
-            if username_specified and user != username_specified:
-                logger.debug("  Skipping add of user %s due to username filter.", user)
-                continue
-            self.stdout.write("Adding user %s to project %s..." % (user, diff["project"]))
+    def get_users(self, usernames):
+        """
+        Returns a dict of User objects keyed by username, creating any users that don't exist yet.
+        Existing users are loaded with one query. New users are created one at a time so ColdFront's
+        post_save receivers still create their profiles, and are then populated from LDAP.
+        """
+        users_by_name = User.objects.in_bulk(usernames, field_name="username")
+        new_usernames = set(usernames) - users_by_name.keys()
+        if not new_usernames:
+            return users_by_name
+        ldap_backend = LDAPBackend()
+        for username in new_usernames:
             try:
-                # add the user to the Project
-                # create a ProjectUser object with status 'Active'
-                user_obj, created = User.objects.get_or_create(username=user)
-                if created:
-                    # populate user details from LDAP
-                    LDAPBackend().populate_user(user_obj)
+                users_by_name[username] = User.objects.create(username=username)
+                # populate user details from LDAP
+                ldap_backend.populate_user(username)
+            except Exception as e:
+                self.stdout.write("Failed to create user %s: %s" % (username, e))
+        return users_by_name
+
+    def set_allocation_users_status(self, allocations, users, status, create_missing=False):
+        """
+        Sets the status of each user in each of the allocations with one bulk update.
+        When create_missing is set, AllocationUser rows that don't exist yet are created in bulk as well.
+        """
+        existing = {
+            (au.allocation_id, au.user_id): au
+            for au in AllocationUser.objects.filter(allocation__in=allocations, user__in=users)
+        }
+        to_update = []
+        to_create = []
+        for allocation in allocations:
+            for user_obj in users:
+                au = existing.get((allocation.pk, user_obj.pk))
+                if au is None:
+                    if create_missing:
+                        to_create.append(AllocationUser(allocation=allocation, user=user_obj, status=status))
+                elif au.status_id != status.pk:
+                    au.status = status
+                    to_update.append(au)
+        # the history-aware bulk helpers keep the allocation user history that save() would record
+        if to_update:
+            bulk_update_with_history(to_update, AllocationUser, ["status"], batch_size=500)
+        if to_create:
+            bulk_create_with_history(to_create, AllocationUser, batch_size=500)
+
+    def group_differences_by_target(self, differences):
+        """
+        Merges the differences of each project or allocation into one set of users to add and one to remove,
+        so each target is synced once however many of its groups differ.
+        The sets can't overlap because every group of a target is compared against the same Coldfront users.
+        """
+        targets = defaultdict(lambda: {"name": None, "add": set(), "remove": set()})
+        for diff in differences:
+            if diff.get("errors", []):
+                logger.warning("Skipping sync for group %s due to errors: %s", diff["group"], "; ".join(diff["errors"]))
+                self.stdout.write(
+                    "Skipping sync for group %s due to errors: %s" % (diff["group"], "; ".join(diff["errors"]))
+                )
+                continue
+            alignment = diff["alignment"]
+            target = targets[diff[f"{alignment}_id"]]
+            target["name"] = diff[alignment]
+            target["add"].update(diff["missing_from_coldfront"])
+            target["remove"].update(diff["missing_from_external"])
+        return targets
 
-                pu, _ = ProjectUser.objects.get_or_create(project=p, user=user_obj, status=active_status, role=user_role)
+    def get_choices(self):
+        """Looks up the status and role choices assigned when syncing to Coldfront, once per run."""
+        return {
+            "project_user_active": ProjectUserStatusChoice.objects.get(name="Active"),
+            "project_user_removed": ProjectUserStatusChoice.objects.get(name="Removed"),
+            "project_user_role": ProjectUserRoleChoice.objects.get(name="User"),
+            "allocation_user_active": AllocationUserStatusChoice.objects.get(name="Active"),
+            "allocation_user_removed": AllocationUserStatusChoice.objects.get(name="Removed"),
+        }
 
-                for allocation in project_allocations:
-                    allocation.add_user(user_obj)
+    def sync_to_coldfront_projects(self, p, target, users_by_name, choices):
+        project_allocations = list(p.allocation_set.all())
+        active_status = choices["project_user_active"]
+        removed_status = choices["project_user_removed"]
+        user_role = choices["project_user_role"]
+        allocation_active_status = choices["allocation_user_active"]
+        allocation_removed_status = choices["allocation_user_removed"]
+        # index the project's users by username so each user is a dict lookup
+        project_users_by_name = {
+            pu.user.username: pu for pu in ProjectUser.objects.filter(project=p).select_related("user")
+        }
+
+        # users that could not be created are skipped; get_users already reported them
+        users_to_add = [users_by_name[user] for user in sorted(target["add"]) if user in users_by_name]
+        if users_to_add:
+            # one write for all of the users added to this project
+            self.stdout.write(
+                "\n".join("Adding user %s to project %s..." % (u.username, target["name"]) for u in users_to_add)
+            )
+            try:
+                # add the users to the Project with status 'Active', reactivating existing ProjectUser rows
+                new_project_users = []
+                changed_project_users = []
+                for user_obj in users_to_add:
+                    pu = project_users_by_name.get(user_obj.username)
+                    if pu is None:
+                        new_project_users.append(
+                            ProjectUser(project=p, user=user_obj, status=active_status, role=user_role)
+                        )
+                    elif pu.status_id != active_status.pk:
+                        pu.status = active_status
+                        changed_project_users.append(pu)
+                if new_project_users:
+                    bulk_create_with_history(new_project_users, ProjectUser, batch_size=500)
+                if changed_project_users:
+                    bulk_update_with_history(changed_project_users, ProjectUser, ["status"], batch_size=500)
+                # and to every allocation in the project
+                self.set_allocation_users_status(
+                    project_allocations, users_to_add, allocation_active_status, create_missing=True
+                )
             except Exception as e:
-                self.stdout.write("Failed to add user %s to project %s: %s" % (user, diff["project"], e))
-        
-        # remove users from project
-        project_users = ProjectUser.objects.filter(project=p)
-        project_allocations = Allocation.objects.filter(project=p)
-        removed_status = ProjectUserStatusChoice.objects.get(name="Removed")
+                self.stdout.write(
+                    "Failed to add users %s to project %s: %s"
+                    % (", ".join(u.username for u in users_to_add), target["name"], e)
+                )
 
-        for user in diff["missing_from_external"]:
-            if username_specified and user != username_specified:
-                logger.debug("  Skipping remove of user %s due to username filter.", user)
-                continue
-            self.stdout.write("Removing user %s from project %s..." % (user, diff["project"]))
+        # remove users from project
+        users_to_remove = sorted(target["remove"])
+        if users_to_remove:
+            self.stdout.write(
+                "\n".join("Removing user %s from project %s..." % (user, target["name"]) for user in users_to_remove)
+            )
             try:
-                # remove the user from the Project
-                for pu in project_users:
-                    if pu.user.username == user:
+                # remove the users from the Project
+                removed_project_users = []
+                for user in users_to_remove:
+                    pu = project_users_by_name.get(user)
+                    if pu is not None and pu.status_id != removed_status.pk:
                         pu.status = removed_status
-                        pu.save()
-                
-                user_obj= User.objects.get(username=user)
-                for allocation in project_allocations:
-                    allocation.remove_user(user_obj)
+                        removed_project_users.append(pu)
+                if removed_project_users:
+                    bulk_update_with_history(removed_project_users, ProjectUser, ["status"], batch_size=500)
+                # and from every allocation in the project
+                users_removed = list(User.objects.filter(username__in=users_to_remove))
+                self.set_allocation_users_status(project_allocations, users_removed, allocation_removed_status)
             except Exception as e:
-                self.stdout.write("Failed to remove user %s from project %s: %s" % (user, diff["project"], e))
+                self.stdout.write(
+                    "Failed to remove users %s from project %s: %s" % (", ".join(users_to_remove), target["name"], e)
+                )
 
-    def sync_to_coldfront_allocations(self, diff, username_specified=None):
-        # get the Allocation object
-        a = Allocation.objects.get(pk=diff["allocation_id"])
-        for user in diff["missing_from_coldfront"]:
-            if username_specified and user != username_specified:
-                logger.debug("  Skipping add of user %s due to username filter.", user)
-                continue
-            self.stdout.write("Adding user %s to allocation %s..." % (user, diff["allocation"]))
+    def sync_to_coldfront_allocations(self, a, target, users_by_name, choices):
+        active_status = choices["allocation_user_active"]
+        removed_status = choices["allocation_user_removed"]
+
+        # users that could not be created are skipped; get_users already reported them
+        users_to_add = [users_by_name[user] for user in sorted(target["add"]) if user in users_by_name]
+        if users_to_add:
+            # one write for all of the users added to this allocation
+            self.stdout.write(
+                "\n".join("Adding user %s to allocation %s..." % (u.username, target["name"]) for u in users_to_add)
+            )
             try:
-                # add the user to the Allocation
-                # create an AllocationUser object with status 'Active'
-                user_obj, created = User.objects.get_or_create(username=user)
-                if created:
-                    # populate user details from LDAP
-                    LDAPBackend().populate_user_from_ldap(user)
-
-                au = AllocationUser(allocation=a, user=user_obj, status="Active")
-                au.save()
+                # add the users to the Allocation with status 'Active', reactivating existing AllocationUser rows
+                self.set_allocation_users_status([a], users_to_add, active_status, create_missing=True)
             except Exception as e:
-                self.stdout.write("Failed to add user %s to allocation %s: %s" % (user, diff["allocation"], e))
-        allocation_users = AllocationUser.objects.filter(allocation=a)
-        for user in diff["missing_from_external"]:
-            if username_specified and user != username_specified:
-                logger.debug("  Skipping remove of user %s due to username filter.", user)
-                continue
-            self.stdout.write("Removing user %s from allocation %s..." % (user, diff["allocation"]))
+                self.stdout.write(
+                    "Failed to add users %s to allocation %s: %s"
+                    % (", ".join(u.username for u in users_to_add), target["name"], e)
+                )
+
+        users_to_remove = sorted(target["remove"])
+        if users_to_remove:
+            self.stdout.write(
+                "\n".join("Removing user %s from allocation %s..." % (user, target["name"]) for user in users_to_remove)
+            )
             try:
-                # remove the user from the Allocation
-                for au in allocation_users:
-                    if au.user.username == user:
-                        au.status = "Removed"
-                        au.save()
+                # remove the users from the Allocation
+                self.set_allocation_users_status(
+                    [a], list(User.objects.filter(username__in=users_to_remove)), removed_status
+                )
             except Exception as e:
                 self.stdout.write(
-                    "Failed to remove user %s from allocation %s: %s" % (user, diff["allocation"], e)
+                    "Failed to remove users %s from allocation %s: %s" % (", ".join(users_to_remove), target["name"], e)
                 )
 
-    def sync_to_coldfront(self, diff, username_specified=None):
+    def sync_to_coldfront(self, obj, target, users_by_name, choices):
         if settings.MANAGE_GROUPS_AT_PROJECT_LEVEL:
-            self.sync_to_coldfront_projects(diff, username_specified)
+            self.sync_to_coldfront_projects(obj, target, users_by_name, choices)
         else:  # allocation level
-            self.sync_to_coldfront_allocations(diff, username_specified)
+            self.sync_to_coldfront_allocations(obj, target, users_by_name, choices)
 
     def handle(self, *args, **options):
         username_specified = options.get("username", None)
         group_specified = options.get("group", None)
         dry_run = options.get("dry_run", False)
-        #no_header = options.get("no_header", False)
+        # no_header = options.get("no_header", False)
         sync_to = options.get("sync_to", False)
         include_new = options.get("include_new", False)
 
@@ -304,27 +478,35 @@ class Command(BaseCommand):
             self.stdout.write("Filtering to group: %s" % group_specified)
         if dry_run:
             self.stdout.write("Dry run mode enabled. No changes will be made.")
-        #if no_header:
-       #     self.stdout.write("No header mode enabled. Header will be excluded from output.")
+        # if no_header:
+        #     self.stdout.write("No header mode enabled. Header will be excluded from output.")
 
         # get list of groups from coldfront mapped to projects/allocations
         # determine whether to sync at the project or allocation level
         group_attribute_name = settings.UNIX_GROUP_ATTRIBUTE_NAME
         if settings.MANAGE_GROUPS_AT_PROJECT_LEVEL:
             self.stdout.write("Managing groups at the project level...")
-            coldfront_users_and_groups = self.collate_project_user_data(group_attribute_name, include_new,group_specified)
+            coldfront_users_and_groups = self.collate_project_user_data(
+                group_attribute_name, include_new, group_specified, username_specified
+            )
 
         else:
             self.stdout.write("Managing groups at the allocation level...")
             # get allocation users mapped to groups and allocations
-            coldfront_users_and_groups = self.collate_allocation_user_data(group_attribute_name, include_new, group_specified)
+            coldfront_users_and_groups = self.collate_allocation_user_data(
+                group_attribute_name, include_new, group_specified, username_specified
+            )
 
         group_set = set([n for sub in coldfront_users_and_groups for n in sub["groups"]])
         # query external system for members of each group
-        external_users_and_groups = self.collate_external_user_data(group_set)
+        # one client is used for the external queries and for syncing changes to the external system
+        client = utils.get_client()
+        external_users_and_groups = self.collate_external_user_data(group_set, client)
 
         # compare coldfront to external system and determine adds/removes
-        differences = self.compare_coldfront_to_external(coldfront_users_and_groups, external_users_and_groups)
+        differences = self.compare_coldfront_to_external(
+            coldfront_users_and_groups, external_users_and_groups, username_specified
+        )
 
         if not dry_run:
             if sync_to:
@@ -332,13 +514,22 @@ class Command(BaseCommand):
                 # sync coldfront users and groups to external system
                 # for each difference, add users missing from external, remove users missing from coldfront
                 for diff in differences:
-                    self.sync_to_external(diff, username_specified)
+                    self.sync_to_external(diff, client)
             else:
                 self.stdout.write("Syncing changes from external system to coldfront..")
                 # sync external group memberships to coldfront
-                # for each difference, add users missing from coldfront, remove users missing from external
-                for diff in differences:
-                    self.sync_to_coldfront(diff, username_specified)
+                # for each project or allocation, add users missing from coldfront, remove users missing from external
+                targets = self.group_differences_by_target(differences)
+                # look up or create every user that will be added once, instead of per user and target
+                users_by_name = self.get_users({user for target in targets.values() for user in target["add"]})
+                # load every project or allocation that has a difference in one query, instead of per target
+                if settings.MANAGE_GROUPS_AT_PROJECT_LEVEL:
+                    objects_by_id = Project.objects.prefetch_related("allocation_set").in_bulk(targets.keys())
+                else:
+                    objects_by_id = Allocation.objects.in_bulk(targets.keys())
+                choices = self.get_choices()
+                for pk, target in targets.items():
+                    self.sync_to_coldfront(objects_by_id[pk], target, users_by_name, choices)
 
             self.stdout.write("Sync complete.")
         else:
@@ -348,7 +539,7 @@ class Command(BaseCommand):
         else:
             self.stdout.write("Found %d differences between Coldfront and external system:" % len(differences))
             for diff in differences:
-                difference_type = "project" if "project" in diff else "allocation"
+                difference_type = diff["alignment"]
                 self.stdout.write(
                     "- %s: %s (ID: %s), Group: %s, Missing from external: %s, Missing from Coldfront: %s"
                     % (
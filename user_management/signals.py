@@ -1,13 +1,15 @@
 import logging
-
-from coldfront.core.allocation.signals import (allocation_activate_user, 
-                                               allocation_remove_user, 
-                                               allocation_activate)
-from coldfront.core.project.signals import project_activate_user, project_archive, project_remove_user
-from django_q.tasks import async_task, async_chain
+import threading
 
 logger = logging.getLogger(__name__)
 
+# nothing reads the tasks' return values, so Django-Q only saves failed runs; chains are left out because
+# Django-Q enqueues a chain's next task only after saving the previous result
+_TASK_OPTIONS = {"save": False}
+
+# per-thread buffer of user tasks raised while a request is being handled; None outside a request
+_batches = threading.local()
+
 
 def init_signal_receivers(project_level=False, remove_on_archive=False):
     """
@@ -15,6 +17,15 @@ def init_signal_receivers(project_level=False, remove_on_archive=False):
     :param project_level: Boolean flag to determine if group management at the project or allocation level.
     :param remove_on_archive: Boolean flag to determine if users should be removed from groups on project archive.
     """
+    # imported here so processes that never wire receivers don't load the signal and task machinery
+    # pylint: disable=import-outside-toplevel
+    from coldfront.core.allocation.signals import allocation_activate, allocation_activate_user, allocation_remove_user
+    from coldfront.core.project.signals import project_activate_user, project_archive, project_remove_user
+    from django.core.signals import request_finished, request_started
+
+    # user tasks raised during a request are enqueued together when the request finishes
+    request_started.connect(start_user_task_batch, dispatch_uid="ump_start_user_task_batch")
+    request_finished.connect(flush_user_task_batch, dispatch_uid="ump_flush_user_task_batch")
 
     # determines whether user groups are set at the 'Project' level or the 'Allocation' level.
     if project_level:  # project level
@@ -25,9 +36,7 @@ def init_signal_receivers(project_level=False, remove_on_archive=False):
         )  # dispatch_uid to avoid duplicate connections
         project_remove_user.connect(remove_project_user, dispatch_uid="ump_remove_project_user_1")
 
-        allocation_activate.connect(
-            sync_project_users, dispatch_uid="ump_sync_project_users_to_allocations_1"
-        )
+        allocation_activate.connect(sync_project_users, dispatch_uid="ump_sync_project_users_to_allocations_1")
         if remove_on_archive:
             logger.warning(
                 "User Management is configured to remove users on project archive. This will remove all users from their groups when a project is archived."
@@ -37,11 +46,9 @@ def init_signal_receivers(project_level=False, remove_on_archive=False):
     else:  # allocation level
         logger.debug("Initializing allocation-level signal receivers for User Management...")
         # connect signals to allocation user management views
+        # each receiver is connected once without a sender, so it runs once for every view that sends the signal
         allocation_activate_user.connect(activate_allocation_user, dispatch_uid="ump_activate_allocation_user_1")
-        allocation_activate_user.connect(activate_allocation_user, dispatch_uid="ump_activate_allocation_user_2")
         allocation_remove_user.connect(remove_allocation_user, dispatch_uid="ump_remove_allocation_user_1")
-        allocation_remove_user.connect(remove_allocation_user, dispatch_uid="ump_remove_allocation_user_2")
-        allocation_remove_user.connect(remove_allocation_user, dispatch_uid="ump_remove_allocation_user_3")
 
         if remove_on_archive:
             logger.warning(
@@ -50,32 +57,74 @@ def init_signal_receivers(project_level=False, remove_on_archive=False):
             project_archive.connect(remove_all_project_users, dispatch_uid="ump_archive_project")
 
 
+def start_user_task_batch(sender, **kwargs):
+    _batches.pending = {}
+
+
+def flush_user_task_batch(sender, **kwargs):
+    """
+    Enqueues the user tasks buffered during the request, one background task per task name
+    (or one chain for chained tasks) however many users the request touched.
+    """
+    pending = getattr(_batches, "pending", None)
+    _batches.pending = None
+    if not pending:
+        return
+    from django_q.tasks import async_chain, async_task  # pylint: disable=import-outside-toplevel
+
+    for task_names, user_pks in pending.items():
+        user_pks = list(user_pks)
+        logger.debug("Enqueuing %s for %d users", ", ".join(task_names), len(user_pks))
+        if len(task_names) == 1:
+            async_task("user_management.tasks.run_user_tasks", task_names[0], user_pks, **_TASK_OPTIONS)
+        else:
+            async_chain([("user_management.tasks.run_user_tasks", [name, user_pks]) for name in task_names])
+
+
+def _enqueue_user_tasks(task_names, user_pk):
+    """Buffers the tasks for the user until the current request finishes, or enqueues them now outside a request."""
+    pending = getattr(_batches, "pending", None)
+    if pending is not None:
+        # a dict keeps the users in the order they were seen and drops repeat signals for the same user
+        pending.setdefault(task_names, {})[user_pk] = None
+        return
+    from django_q.tasks import async_chain, async_task  # pylint: disable=import-outside-toplevel
+
+    if len(task_names) == 1:
+        async_task(f"user_management.tasks.{task_names[0]}", user_pk, **_TASK_OPTIONS)
+    else:
+        async_chain([(f"user_management.tasks.{name}", [user_pk]) for name in task_names])
+
+
 def activate_allocation_user(sender, **kwargs):
     user_pk = kwargs.get("allocation_user_pk")
-    async_task("user_management.tasks.add_allocation_user_to_group", user_pk)
+    _enqueue_user_tasks(("add_allocation_user_to_group",), user_pk)
 
 
 def remove_allocation_user(sender, **kwargs):
     user_pk = kwargs.get("allocation_user_pk")
-    async_task("user_management.tasks.remove_allocation_user_from_group", user_pk)
+    _enqueue_user_tasks(("remove_allocation_user_from_group",), user_pk)
 
 
 def activate_project_user(sender, **kwargs):
     user_pk = kwargs.get("project_user_pk")
-    async_chain([("user_management.tasks.add_project_user_to_group", [user_pk]),
-                 ("user_management.tasks.add_project_user_to_allocations", [user_pk])])
+    _enqueue_user_tasks(("add_project_user_to_group", "add_project_user_to_allocations"), user_pk)
 
 
 def remove_project_user(sender, **kwargs):
     user_pk = kwargs.get("project_user_pk")
-    async_task("user_management.tasks.remove_project_user_from_group", user_pk)
+    _enqueue_user_tasks(("remove_project_user_from_group",), user_pk)
 
 
 def remove_all_project_users(sender, **kwargs):
+    from django_q.tasks import async_task  # pylint: disable=import-outside-toplevel
+
     project_pk = kwargs.get("project_pk")
-    async_task("user_management.tasks.remove_all_project_users_from_groups", project_pk)
+    async_task("user_management.tasks.remove_all_project_users_from_groups", project_pk, **_TASK_OPTIONS)
 
 
 def sync_project_users(sender, **kwargs):
+    from django_q.tasks import async_task  # pylint: disable=import-outside-toplevel
+
     allocation_pk = kwargs.get("allocation_pk")
-    async_task("user_management.tasks.sync_all_project_users_to_allocations", allocation_pk)
\ No newline at end of file
+    async_task("user_management.tasks.sync_all_project_users_to_allocations", allocation_pk)
@@ -1,14 +1,116 @@
+import functools
+import itertools
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
-from coldfront.core.allocation.models import AllocationUser, Allocation
+from coldfront.core.allocation.models import Allocation, AllocationUser
 from coldfront.core.allocation.utils import set_allocation_user_status_to_error
 from coldfront.core.project.models import Project, ProjectUser
 from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.signals import setting_changed
+from django.db import connections
+from django.db.models import Q
 
 from user_management import utils
 
 logger = logging.getLogger(__name__)
 
+# allocation statuses in which a removed user is taken out of the allocation's groups
+_REMOVABLE_ALLOCATION_STATUSES = frozenset({"Active", "Pending", "Inactive (Renewed)"})
+# project statuses in which a removed user is left in the project's groups
+_ARCHIVED_PROJECT_STATUSES = frozenset({"Archived"})
+
+
+@functools.lru_cache(maxsize=1)
+def _group_attribute_name():
+    """Returns the UNIX_GROUP_ATTRIBUTE_NAME setting. It is read once and reused by every task run in the process."""
+    return settings.UNIX_GROUP_ATTRIBUTE_NAME
+
+
+def _reset_group_attribute_name(setting, **kwargs):
+    # keeps the cached name current when the setting is overridden, e.g. in tests
+    if setting == "UNIX_GROUP_ATTRIBUTE_NAME":
+        _group_attribute_name.cache_clear()
+
+
+setting_changed.connect(_reset_group_attribute_name, dispatch_uid="ump_reset_group_attribute_name")
+
+# per-thread cache of group lookups, only set while a batch of user tasks runs
+_group_lookups = threading.local()
+
+
+@contextmanager
+def _cached_group_lookups():
+    """
+    Reuses each project's and allocation's group lookup for the tasks run inside the block,
+    and shares one caching client between them so each external group is only looked up once.
+    """
+    _group_lookups.cache = {}
+    _group_lookups.client = None
+    try:
+        yield
+    finally:
+        _group_lookups.cache = None
+        _group_lookups.client = None
+
+
+def _batch_client():
+    """Returns the client shared by the current batch of user tasks, or None outside a batch."""
+    if getattr(_group_lookups, "cache", None) is None:
+        return None
+    # created on first use, so a client that can't be loaded fails the task that needs it, like outside a batch
+    if _group_lookups.client is None:
+        _group_lookups.client = utils.CachingClient(utils.get_client())
+    return _group_lookups.client
+
+
+def _get_groups(kind, obj, group_attribute_name, lookup):
+    cache = getattr(_group_lookups, "cache", None)
+    if cache is None:
+        return lookup(obj, group_attribute_name)
+    key = (kind, obj.pk, group_attribute_name)
+    if key not in cache:
+        cache[key] = frozenset(lookup(obj, group_attribute_name))
+    return cache[key]
+
+
+def _get_other_groups(kind, user, group_attribute_name, current_id, groups, lookup):
+    """
+    Returns which of the groups the user also has in other active projects or allocations. Inside a batch
+    the answer is reused when the same user is handled again for the same project or allocation.
+    """
+    cache = getattr(_group_lookups, "cache", None)
+    if cache is None:
+        return lookup(user, group_attribute_name, current_id, candidate_groups=groups)
+    # the candidate groups come from the same batch cache, so they're fixed by the rest of the key
+    key = ("other " + kind, user.pk, group_attribute_name, current_id)
+    if key not in cache:
+        cache[key] = frozenset(lookup(user, group_attribute_name, current_id, candidate_groups=groups))
+    return cache[key]
+
+
+def _get_allocation_groups(allocation, group_attribute_name):
+    """Returns the groups in the allocation's group attributes, as returned by the lookup."""
+    return _get_groups("allocation", allocation, group_attribute_name, lambda a, name: a.get_attribute_list(name))
+
+
+def _get_project_groups(project, group_attribute_name):
+    """Returns the groups in the project's group attributes, as returned by the lookup."""
+    return _get_groups("project", project, group_attribute_name, utils.get_project_attribute_values_set)
+
+
+def _as_set(groups):
+    # a new set is only built when the lookup didn't return one; cached frozensets are passed on as they are
+    return groups if isinstance(groups, (set, frozenset)) else set(groups)
+
+
+def _get_allocation_user(user_pk):
+    """Loads the allocation user together with the allocation, statuses and user the tasks read, in one query."""
+    return AllocationUser.objects.select_related("allocation__status", "status", "user").get(pk=user_pk)
+
 
 def add_allocation_user_to_group(user_pk):
     """
@@ -18,9 +120,9 @@ def add_allocation_user_to_group(user_pk):
     If the allocation does not have any groups defined, the function will log an info message and return.
     On error, the allocation user's status will be set to 'Error'.
     """
-    group_attribute_name = settings.UNIX_GROUP_ATTRIBUTE_NAME
+    group_attribute_name = _group_attribute_name()
 
-    allocation_user = AllocationUser.objects.get(pk=user_pk)
+    allocation_user = _get_allocation_user(user_pk)
     if allocation_user.allocation.status.name != "Active":
         logger.warning("Allocation is not active. Will not add user")
         return False
@@ -29,22 +131,33 @@ def add_allocation_user_to_group(user_pk):
         logger.warning("Allocation user status is not 'Active'. Will not add user.")
         return False
 
-    groups = set(allocation_user.allocation.get_attribute_list(group_attribute_name))
-    logger.debug("DEBUG: groups from allocation attribute '%s': %s", group_attribute_name, groups)
-    if len(groups) == 0:
+    groups = _get_allocation_groups(allocation_user.allocation, group_attribute_name)
+    # the debug arguments are only gathered when DEBUG is enabled
+    debug_enabled = logger.isEnabledFor(logging.DEBUG)
+    if debug_enabled:
+        logger.debug("DEBUG: groups from allocation attribute '%s': %s", group_attribute_name, groups)
+    if not groups:
         logger.info("Allocation does not have any groups. Nothing to add")
         return False
-    logger.debug(
-        "DEBUG: calling add_user_to_group_set for user %s and groups %s", allocation_user.user.username, groups
-    )
+    if debug_enabled:
+        logger.debug(
+            "DEBUG: calling add_user_to_group_set for user %s and groups %s", allocation_user.user.username, groups
+        )
     utils.add_user_to_group_set(
-        allocation_user.user.username, groups, 
+        allocation_user.user.username,
+        _as_set(groups),
         error_callback=set_allocation_user_status_to_error,
-        callback_args=(allocation_user.pk,)
+        callback_args=(allocation_user.pk,),
+        client=_batch_client(),
     )  # for allocation: set_allocation_user_status_to_error(user_pk) on error
     return True
 
 
+def _get_project_user(user_pk):
+    """Loads the project user together with the project, statuses and user the tasks read, in one query."""
+    return ProjectUser.objects.select_related("project__status", "status", "user").get(pk=user_pk)
+
+
 def add_project_user_to_group(user_pk):
     """
     Adds the user to all groups defined in the project's attributes. The name of the attribute
@@ -53,9 +166,9 @@ def add_project_user_to_group(user_pk):
     If the project does not have any groups defined, the function will log an info message and return.
     On error, the project user's status will be set to 'Error'.
     """
-    group_attribute_name = settings.UNIX_GROUP_ATTRIBUTE_NAME
+    group_attribute_name = _group_attribute_name()
 
-    project_user = ProjectUser.objects.get(pk=user_pk)
+    project_user = _get_project_user(user_pk)
     if project_user.project.status.name != "Active":
         logger.warning("Project is not active. Will not add user")
         return
@@ -63,16 +176,18 @@ def add_project_user_to_group(user_pk):
     if project_user.status.name != "Active":
         logger.warning("Project user status is not 'Active'. Will not add user.")
         return
-    
-    groups = utils.get_project_attribute_values_set(project_user.project, group_attribute_name)
-    if len(groups) == 0:
+
+    groups = _get_project_groups(project_user.project, group_attribute_name)
+    if not groups:
         logger.info("Project does not have any groups. Nothing to add")
         return
 
     utils.add_user_to_group_set(
-        project_user.user.username, groups, 
+        project_user.user.username,
+        _as_set(groups),
         error_callback=utils.set_project_user_status_to_pending,
-        callback_args=(project_user.pk)
+        callback_args=(project_user.pk,),
+        client=_batch_client(),
     )
 
 
@@ -80,11 +195,15 @@ def add_project_user_to_allocations(user_pk):
     """
     Adds the user to all allocations in the project that the project user belongs to. This is necessary when group membership is managed at the project level
     """
-    project_user = ProjectUser.objects.get(pk=user_pk)
-    logger.info("Adding user %s to active allocations in project %s", project_user.user.username, project_user.project.title)
+    project_user = _get_project_user(user_pk)
+    logger.info(
+        "Adding user %s to active allocations in project %s", project_user.user.username, project_user.project.title
+    )
     allocations = Allocation.objects.filter(project=project_user.project, status__name="Active")
+    debug_enabled = logger.isEnabledFor(logging.DEBUG)
     for alloc in allocations.iterator():
-        logger.debug("Adding user %s to allocation %s", project_user.user.username, alloc.pk)
+        if debug_enabled:
+            logger.debug("Adding user %s to allocation %s", project_user.user.username, alloc.pk)
         alloc.add_user(project_user.user)
 
 
@@ -97,15 +216,11 @@ def remove_allocation_user_from_group(user_pk):
     The user will only be removed from groups they do not belong to in other active allocations.
     On error, the allocation user's status will be set to 'Error'.
     """
-    group_attribute_name = settings.UNIX_GROUP_ATTRIBUTE_NAME
+    group_attribute_name = _group_attribute_name()
 
-    allocation_user = AllocationUser.objects.get(pk=user_pk)
+    allocation_user = _get_allocation_user(user_pk)
     # check allocation status
-    if allocation_user.allocation.status.name not in [
-        "Active",
-        "Pending",
-        "Inactive (Renewed)",
-    ]:
+    if allocation_user.allocation.status.name not in _REMOVABLE_ALLOCATION_STATUSES:
         logger.warning("Allocation is not active or pending. Will not remove user from group")
         return
     # check allocation user status
@@ -113,29 +228,37 @@ def remove_allocation_user_from_group(user_pk):
         logger.warning("Allocation user status is not 'Removed'. Will not remove user from group.")
         return
 
-    groups = allocation_user.allocation.get_attribute_list(group_attribute_name)
-    if len(groups) == 0:
+    groups = _get_allocation_groups(allocation_user.allocation, group_attribute_name)
+    if not groups:
         logger.info("Allocation does not have any groups. Nothing to remove")
         return
 
+    groups = frozenset(groups)
     # Ensure we don't remove the user from groups they belong to in other active allocations.
-    other_groups = utils.collect_other_allocation_user_groups(
-        allocation_user.user, group_attribute_name, allocation_user.allocation.pk
+    # Only this allocation's groups are looked for, so the database returns just the ones to keep.
+    other_groups = _get_other_groups(
+        "allocation",
+        allocation_user.user,
+        group_attribute_name,
+        allocation_user.allocation.pk,
+        groups,
+        utils.collect_other_allocation_user_groups,
     )
-
-    group_diff = set(groups).difference(other_groups)
+    group_diff = groups.difference(other_groups)
 
     if len(group_diff) == 0:
         logger.info(
             "No groups to remove. User may belong to these groups in other active allocations: %s",
-            set(groups).intersection(other_groups),
+            groups.intersection(other_groups),
         )
         return
 
     utils.remove_user_from_group_set(
-        allocation_user.user.username, group_diff, 
+        allocation_user.user.username,
+        group_diff,
         error_callback=set_allocation_user_status_to_error,
-        callback_args=(allocation_user.pk,)
+        callback_args=(allocation_user.pk,),
+        client=_batch_client(),
     )  # for allocation: set_allocation_user_status_to_error(user_pk) on error
 
 
@@ -149,27 +272,31 @@ def remove_project_user_from_group(user_pk):
     The user will only be removed from groups they do not belong to in other active projects.
     On error, the project user's status will be set to 'Error'.
     """
-    group_attribute_name = settings.UNIX_GROUP_ATTRIBUTE_NAME
-    project_user = ProjectUser.objects.get(pk=user_pk)
-    if project_user.project.status.name in [
-        "Archived",
-    ]:
+    group_attribute_name = _group_attribute_name()
+    project_user = _get_project_user(user_pk)
+    if project_user.project.status.name in _ARCHIVED_PROJECT_STATUSES:
         logger.warning("Project is archived. Will not remove user from group")
         return
 
     if project_user.status.name != "Removed":
         logger.warning("Project user status is not 'Removed'. Will not remove user from group.")
         return
-    groups = utils.get_project_attribute_values_set(project_user.project, group_attribute_name)
-    if len(groups) == 0:
+    groups = _get_project_groups(project_user.project, group_attribute_name)
+    if not groups:
         logger.info("Project does not have any groups. Nothing to remove")
         return
 
     # Ensure we don't remove the user from groups they belong to in other active projects.
-    other_groups = utils.collect_other_project_user_groups(
-        project_user.user, group_attribute_name, project_user.project.pk
+    # Only this project's groups are looked for, so the database returns just the ones to keep.
+    other_groups = _get_other_groups(
+        "project",
+        project_user.user,
+        group_attribute_name,
+        project_user.project.pk,
+        groups,
+        utils.collect_other_project_user_groups,
     )
-    group_diff = groups.difference(other_groups)
+    group_diff = _as_set(groups).difference(other_groups)
 
     if len(group_diff) == 0:
         logger.info(
@@ -178,9 +305,11 @@ def remove_project_user_from_group(user_pk):
         return
 
     utils.remove_user_from_group_set(
-        project_user.user.username, group_diff, 
+        project_user.user.username,
+        group_diff,
         error_callback=utils.set_project_user_status_to_pending,
-        callback_args=(project_user.pk)
+        callback_args=(project_user.pk,),
+        client=_batch_client(),
     )
 
 
@@ -192,45 +321,116 @@ def remove_all_project_users_from_groups(project_pk):
     The user will only be removed from groups they do not belong to in other active projects.
     On error, the project user's status will be set to 'Error'.
     """
-    group_attribute_name = settings.UNIX_GROUP_ATTRIBUTE_NAME
+    group_attribute_name = _group_attribute_name()
     project = Project.objects.get(pk=project_pk)
     if project.status.name != "Archived":
         logger.warning("Project is not archived. Will not remove users from groups")
         return
 
-    groups = utils.get_project_attribute_values_set(project, group_attribute_name)
-    if len(groups) == 0:
+    groups = _get_project_groups(project, group_attribute_name)
+    if not groups:
         logger.info("Project does not have any groups. Nothing to remove")
         return
 
-    project_users = ProjectUser.objects.filter(project__pk=project_pk)
-    for project_user in project_users:
-        # Ensure we don't remove the user from groups they belong to in other active projects.
-        other_groups = utils.collect_other_project_user_groups(project_user.user, group_attribute_name, project_pk)
-        group_diff = set(groups).difference(other_groups)
+    # hashed once here and reused for every user's difference below
+    groups = frozenset(groups)
+    pi_user = project.pi
+    # Ensure we don't remove users from groups they belong to in other active projects.
+    # The other groups of every user and the PI are collected with one query, using the users as a subquery.
+    users = User.objects.filter(Q(projectuser__project__pk=project_pk) | Q(pk=pi_user.pk)).distinct()
+    other_groups_by_user = utils.collect_other_project_user_groups_bulk(
+        users, group_attribute_name, project_pk, candidate_groups=groups
+    )
+    # stream the project users with only the columns used below, so large projects aren't loaded at once
+    project_users = (
+        ProjectUser.objects.filter(project__pk=project_pk)
+        .select_related("user")
+        .only("user", "user__username")
+        .iterator(chunk_size=2000)
+    )
+    # the PI is handled like the project users, but without an error callback
+    targets = itertools.chain(
+        (
+            (
+                "user",
+                project_user.user,
+                {"error_callback": utils.set_project_user_status_to_pending, "callback_args": (project_user.pk,)},
+            )
+            for project_user in project_users
+        ),
+        [("PI", pi_user, {})],
+    )
+    # the removals share one caching client, so each group's existence and members are only looked up once
+    client = utils.CachingClient(utils.get_client())
+    # users are removed concurrently below, so each user's groups are handled one after another;
+    # that keeps the number of simultaneous external requests at USER_MANAGEMENT_SYNC_CONCURRENCY
+    removals = []
+    # a PI who is also a project user is only removed once, as a project user
+    seen_user_pks = set()
+    for role, user, kwargs in targets:
+        if user.pk in seen_user_pks:
+            continue
+        seen_user_pks.add(user.pk)
+        other_groups = other_groups_by_user.get(user.pk, set())
+        group_diff = groups.difference(other_groups)
 
         if len(group_diff) == 0:
             logger.info(
-                "No groups to remove for user %s. User may belong to these groups in other active or new projects: %s",
-                project_user.user.username,
+                "No groups to remove for %s %s. User may belong to these groups in other active or new projects: %s",
+                role,
+                user.username,
                 other_groups,
             )
             continue
-        utils.remove_user_from_group_set(
-            project_user.user.username, group_diff, 
-            error_callback=utils.set_project_user_status_to_pending,
-            callback_args=(project_user.pk)
-        )
+        removals.append((user.username, group_diff, {**kwargs, "client": client, "max_workers": 1}))
 
-    # remove PI from project groups as well
-    pi_user = project.pi
-    other_groups = utils.collect_other_project_user_groups(pi_user, group_attribute_name, project_pk)
-    group_diff = set(groups).difference(other_groups)
-    if len(group_diff) == 0:
-        logger.info(
-            "No groups to remove for PI %s. User may belong to these groups in other active or new projects: %s",
-            pi_user.username,
-            other_groups,
-        )
+    if not removals:
         return
-    utils.remove_user_from_group_set(pi_user.username, group_diff)
+    # each removal is a series of blocking calls to the external system, so several users are removed at once
+    max_workers = min(getattr(settings, "USER_MANAGEMENT_SYNC_CONCURRENCY", 8), len(removals))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(_remove_user_from_group_set, removals))
+
+
+def _remove_user_from_group_set(removal):
+    username, groups, kwargs = removal
+    try:
+        utils.remove_user_from_group_set(username, groups, **kwargs)
+    finally:
+        # an error callback opens a database connection in the worker thread; don't leave it open
+        connections.close_all()
+
+
+# per-user tasks that signal receivers can batch through run_user_tasks
+_USER_TASKS = (
+    "add_allocation_user_to_group",
+    "remove_allocation_user_from_group",
+    "add_project_user_to_group",
+    "add_project_user_to_allocations",
+    "remove_project_user_from_group",
+)
+
+
+def run_user_tasks(task_name, user_pks):
+    """
+    Runs one of the per-user tasks for each of the user pks, so users added or removed together
+    are handled by a single background task. A failure for one user is logged and does not stop the others;
+    once every user has been handled, a RuntimeError naming the failed users marks the task as failed.
+    """
+    if task_name not in _USER_TASKS:
+        logger.error("Unknown user task %s.", task_name)
+        raise ValueError(f"Unknown user task {task_name}.")
+    task = globals()[task_name]
+    # users in a batch usually share a project or allocation, so its groups are only looked up once
+    failed_user_pks = []
+    with _cached_group_lookups():
+        for user_pk in user_pks:
+            try:
+                task(user_pk)
+            # pylint: disable=broad-except
+            except Exception as e:
+                logger.error("Failed running %s for user %s: %s", task_name, user_pk, e)
+                failed_user_pks.append(user_pk)
+    if failed_user_pks:
+        # the task's result isn't saved on success, so raising is what leaves a record of the failures
+        raise RuntimeError(f"{task_name} failed for {len(failed_user_pks)} of {len(user_pks)} users: {failed_user_pks}")
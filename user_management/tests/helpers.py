@@ -1,6 +1,9 @@
+from collections import defaultdict
+
+
 class UserManagementClient:
     def __init__(self):
-        self.groups = {}
+        self.groups = defaultdict(set)
 
     @staticmethod
     def get_config():
@@ -11,29 +14,41 @@ class UserManagementClient:
         pass
 
     def add_user_to_group(self, user, group):
-        if group not in self.groups.keys():
-            self.groups[group] = set()
         self.groups[group].add(user)
         return True
 
     def remove_user_from_group(self, user, group):
-        if group not in self.groups.keys():
+        if group not in self.groups:
             return False
         if user not in self.groups[group]:
             return False
         self.groups[group].remove(user)
         return True
 
+    def add_users_to_group(self, users, group):
+        self.groups[group].update(users)
+        return True
+
+    def remove_users_from_group(self, users, group):
+        if group not in self.groups:
+            return False
+        self.groups[group].difference_update(users)
+        return True
+
     def user_in_group(self, user, group):
         return group in self.groups and user in self.groups[group]
 
     def group_exists(self, group):
-        return group in self.groups.keys()
+        return group in self.groups
+
+    def groups_exist(self, groups):
+        return {group: group in self.groups for group in groups}
+
+    def get_user_groups(self, user):
+        return {group for group, members in self.groups.items() if user in members}
 
     def get_group_members(self, group):
-        if group in self.groups:
-            return list(self.groups[group])
-        return []
+        return set(self.groups.get(group, ()))
 
     def create_group(self, group):
         if group in self.groups:
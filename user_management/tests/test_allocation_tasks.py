@@ -2,38 +2,43 @@ from unittest.mock import patch
 
 from coldfront.core.allocation.utils import set_allocation_user_status_to_error
 from coldfront.core.test_helpers.factories import AllocationUserFactory
-from django.test import TestCase, override_settings
+from django.test import SimpleTestCase, override_settings
 
-from user_management.tasks import add_allocation_user_to_group, remove_allocation_user_from_group
+from user_management.tasks import add_allocation_user_to_group, remove_allocation_user_from_group, run_user_tasks
 
 
 @override_settings(USER_MANAGEMENT_CLIENT_PATH="user_management/tests/helpers.py")
 @override_settings(UNIX_GROUP_ATTRIBUTE_NAME="ad_group")
-class AddAllocationUserToGroupTests(TestCase):
+class AddAllocationUserToGroupTests(SimpleTestCase):
     def setUp(self):
-        self.allocation_user = AllocationUserFactory()
+        self.allocation_user = AllocationUserFactory.build()
         self.allocation_user.user.username = "testuser"
+        self.allocation_user.pk = 1
 
     @patch("user_management.tasks.AllocationUser")
     @patch("user_management.utils.add_user_to_group_set")
     def test_success(self, mock_add_user_to_group_set, mock_AllocationUser):
         self.allocation_user.status.name = "Active"
         self.allocation_user.allocation.status.name = "Active"
-        self.allocation_user.allocation.get_attribute_list = (
-            lambda group_attr_name: ["group1", "group2"] if group_attr_name == "ad_group" else []
+        self.allocation_user.allocation.get_attribute_list = lambda group_attr_name: (
+            ["group1", "group2"] if group_attr_name == "ad_group" else []
         )
-        mock_AllocationUser.objects.get.return_value = self.allocation_user
+        mock_AllocationUser.objects.select_related.return_value.get.return_value = self.allocation_user
         mock_add_user_to_group_set.return_value = None
         _ = add_allocation_user_to_group(int(mock_AllocationUser.pk))
         mock_add_user_to_group_set.assert_called_once_with(
-            "testuser", {"group1", "group2"}, error_callback=set_allocation_user_status_to_error
+            "testuser",
+            {"group1", "group2"},
+            error_callback=set_allocation_user_status_to_error,
+            callback_args=(self.allocation_user.pk,),
+            client=None,
         )
 
     @patch("user_management.tasks.AllocationUser")
     @patch("user_management.tasks.logger")
     def test_allocation_not_active(self, mock_logger, mock_AllocationUser):
         self.allocation_user.allocation.status.name = "New"
-        mock_AllocationUser.objects.get.return_value = self.allocation_user
+        mock_AllocationUser.objects.select_related.return_value.get.return_value = self.allocation_user
         success = add_allocation_user_to_group(self.allocation_user.pk)
         mock_logger.warning.assert_called_with("Allocation is not active. Will not add user")
         self.assertFalse(success)
@@ -43,7 +48,7 @@ class AddAllocationUserToGroupTests(TestCase):
     def test_user_status_new(self, mock_logger, mock_allocation_user):
         self.allocation_user.allocation.status.name = "Active"
         self.allocation_user.status.name = "New"
-        mock_allocation_user.objects.get.return_value = self.allocation_user
+        mock_allocation_user.objects.select_related.return_value.get.return_value = self.allocation_user
         success = add_allocation_user_to_group(mock_allocation_user.pk)
         mock_logger.warning.assert_called_with("Allocation user status is not 'Active'. Will not add user.")
         self.assertFalse(success)
@@ -53,7 +58,7 @@ class AddAllocationUserToGroupTests(TestCase):
     def test_user_status_not_active(self, mock_logger, mock_allocation_user):
         self.allocation_user.status.name = "Removed"
         self.allocation_user.allocation.status.name = "Active"
-        mock_allocation_user.objects.get.return_value = self.allocation_user
+        mock_allocation_user.objects.select_related.return_value.get.return_value = self.allocation_user
         success = add_allocation_user_to_group(mock_allocation_user.pk)
         mock_logger.warning.assert_called_with("Allocation user status is not 'Active'. Will not add user.")
         self.assertFalse(success)
@@ -62,7 +67,7 @@ class AddAllocationUserToGroupTests(TestCase):
     @patch("user_management.tasks.logger")
     def test_no_groups(self, mock_logger, mock_allocation_user):
         self.allocation_user.allocation.get_attribute_list = lambda group_attr_name: []
-        mock_allocation_user.objects.get.return_value = self.allocation_user
+        mock_allocation_user.objects.select_related.return_value.get.return_value = self.allocation_user
         success = add_allocation_user_to_group(mock_allocation_user.pk)
         mock_logger.info.assert_called_with("Allocation does not have any groups. Nothing to add")
         self.assertFalse(success)
@@ -70,10 +75,11 @@ class AddAllocationUserToGroupTests(TestCase):
 
 @override_settings(USER_MANAGEMENT_CLIENT_PATH="user_management/tests/helpers.py")
 @override_settings(UNIX_GROUP_ATTRIBUTE_NAME="ad_group")
-class RemoveAllocationUserFromGroupTests(TestCase):
+class RemoveAllocationUserFromGroupTests(SimpleTestCase):
     def setUp(self):
-        self.allocation_user = AllocationUserFactory()
+        self.allocation_user = AllocationUserFactory.build()
         self.allocation_user.user.username = "testuser"
+        self.allocation_user.pk = 1
 
     @patch("user_management.utils.remove_user_from_group_set")
     @patch("user_management.utils.collect_other_allocation_user_groups")
@@ -83,24 +89,31 @@ class RemoveAllocationUserFromGroupTests(TestCase):
     ):
         self.allocation_user.status.name = "Removed"
         self.allocation_user.allocation.status.name = "Active"
-        self.allocation_user.allocation.get_attribute_list = (
-            lambda group_attr_name: ["group1", "group2"] if group_attr_name == "ad_group" else []
+        self.allocation_user.allocation.get_attribute_list = lambda group_attr_name: (
+            ["group1", "group2"] if group_attr_name == "ad_group" else []
         )
-        mock_allocation_user.objects.get.return_value = self.allocation_user
+        mock_allocation_user.objects.select_related.return_value.get.return_value = self.allocation_user
         mock_collect_other_allocation_user_groups.return_value = []
         remove_allocation_user_from_group(mock_allocation_user.pk)
         mock_collect_other_allocation_user_groups.assert_called_once_with(
-            self.allocation_user.user, "ad_group", self.allocation_user.allocation.pk
+            self.allocation_user.user,
+            "ad_group",
+            self.allocation_user.allocation.pk,
+            candidate_groups=frozenset({"group1", "group2"}),
         )
         mock_remove_user_from_group_set.assert_called_once_with(
-            "testuser", {"group1", "group2"}, error_callback=set_allocation_user_status_to_error
+            "testuser",
+            {"group1", "group2"},
+            error_callback=set_allocation_user_status_to_error,
+            callback_args=(self.allocation_user.pk,),
+            client=None,
         )
 
     @patch("user_management.tasks.AllocationUser")
     @patch("user_management.tasks.logger")
     def test_allocation_not_active(self, mock_logger, mock_allocation_user):
         self.allocation_user.allocation.status.name = "New"
-        mock_allocation_user.objects.get.return_value = self.allocation_user
+        mock_allocation_user.objects.select_related.return_value.get.return_value = self.allocation_user
         remove_allocation_user_from_group(mock_allocation_user.pk)
         mock_logger.warning.assert_called_with("Allocation is not active or pending. Will not remove user from group")
 
@@ -109,7 +122,7 @@ class RemoveAllocationUserFromGroupTests(TestCase):
     def test_user_status_not_removed(self, mock_logger, mock_allocation_user):
         self.allocation_user.allocation.status.name = "Active"
         self.allocation_user.status.name = "Active"
-        mock_allocation_user.objects.get.return_value = self.allocation_user
+        mock_allocation_user.objects.select_related.return_value.get.return_value = self.allocation_user
         remove_allocation_user_from_group(mock_allocation_user.pk)
         mock_logger.warning.assert_called_with(
             "Allocation user status is not 'Removed'. Will not remove user from group."
@@ -121,6 +134,70 @@ class RemoveAllocationUserFromGroupTests(TestCase):
         self.allocation_user.status.name = "Removed"
         self.allocation_user.allocation.status.name = "Active"
         self.allocation_user.allocation.get_attribute_list = lambda group_attr_name: []
-        mock_allocation_user.objects.get.return_value = self.allocation_user
+        mock_allocation_user.objects.select_related.return_value.get.return_value = self.allocation_user
         remove_allocation_user_from_group(mock_allocation_user.pk)
         mock_logger.info.assert_called_with("Allocation does not have any groups. Nothing to remove")
+
+
+class RunUserTasksTests(SimpleTestCase):
+    @patch("user_management.tasks.logger")
+    @patch("user_management.tasks.add_allocation_user_to_group")
+    def test_runs_task_for_every_user(self, mock_add_allocation_user_to_group, mock_logger):
+        mock_add_allocation_user_to_group.side_effect = [True, Exception("boom"), True]
+        # the failure doesn't stop the other users, but the batch still fails once they're done
+        with self.assertRaisesMessage(RuntimeError, "add_allocation_user_to_group failed for 1 of 3 users: [2]"):
+            run_user_tasks("add_allocation_user_to_group", [1, 2, 3])
+        assert [c.args for c in mock_add_allocation_user_to_group.call_args_list] == [(1,), (2,), (3,)]
+        mock_logger.error.assert_called_once()
+
+    @override_settings(UNIX_GROUP_ATTRIBUTE_NAME="ad_group")
+    @patch("user_management.utils.remove_user_from_group_set")
+    @patch("user_management.utils.collect_other_allocation_user_groups")
+    @patch("user_management.tasks.AllocationUser")
+    def test_other_groups_lookup_shared_in_batch(
+        self, mock_AllocationUser, mock_collect_other_allocation_user_groups, mock_remove_user_from_group_set
+    ):
+        allocation_user = AllocationUserFactory.build()
+        allocation_user.status.name = "Removed"
+        allocation_user.allocation.status.name = "Active"
+        allocation_user.allocation.get_attribute_list = lambda name: ["group1", "group2"]
+        mock_AllocationUser.objects.select_related.return_value.get.return_value = allocation_user
+        mock_collect_other_allocation_user_groups.return_value = {"group2"}
+        # the same user queued twice in one batch
+        run_user_tasks("remove_allocation_user_from_group", [1, 1])
+        mock_collect_other_allocation_user_groups.assert_called_once()
+        assert [c.args[1] for c in mock_remove_user_from_group_set.call_args_list] == [{"group1"}, {"group1"}]
+
+    @override_settings(UNIX_GROUP_ATTRIBUTE_NAME="ad_group")
+    @patch("user_management.utils.add_user_to_group_set")
+    @patch("user_management.tasks.AllocationUser")
+    def test_group_lookup_shared_in_batch(self, mock_AllocationUser, mock_add_user_to_group_set):
+        allocation_user = AllocationUserFactory.build()
+        allocation_user.status.name = "Active"
+        allocation_user.allocation.status.name = "Active"
+        lookups = []
+        allocation_user.allocation.get_attribute_list = lambda name: lookups.append(name) or ["group1"]
+        mock_AllocationUser.objects.select_related.return_value.get.return_value = allocation_user
+        run_user_tasks("add_allocation_user_to_group", [1, 2, 3])
+        assert mock_add_user_to_group_set.call_count == 3
+        assert lookups == ["ad_group"]
+        # the batch shares one client
+        assert len({id(c.kwargs["client"]) for c in mock_add_user_to_group_set.call_args_list}) == 1
+
+    @patch("user_management.utils.add_user_to_group_set")
+    @patch("user_management.tasks.AllocationUser")
+    def test_group_attribute_name_follows_setting(self, mock_AllocationUser, mock_add_user_to_group_set):
+        allocation_user = AllocationUserFactory.build()
+        allocation_user.status.name = "Active"
+        allocation_user.allocation.status.name = "Active"
+        lookups = []
+        allocation_user.allocation.get_attribute_list = lambda name: lookups.append(name) or ["group1"]
+        mock_AllocationUser.objects.select_related.return_value.get.return_value = allocation_user
+        for name in ("ad_group", "unix_group"):
+            with self.settings(UNIX_GROUP_ATTRIBUTE_NAME=name):
+                run_user_tasks("add_allocation_user_to_group", [1])
+        assert lookups == ["ad_group", "unix_group"]
+
+    def test_unknown_task(self):
+        with self.assertRaises(ValueError):
+            run_user_tasks("init_signal_receivers", [1])
@@ -0,0 +1,121 @@
+from types import SimpleNamespace
+from unittest.mock import Mock, patch
+
+import requests
+from django.test import SimpleTestCase, override_settings
+
+from user_management.grouper_user_management_client import UserManagementClient, _shared_session
+from user_management.utils import add_user_to_group_set, remove_user_from_group_set
+
+
+def build_client(grouper):
+    """Builds the Grouper user management client around a stand-in for the grouper_client library's client."""
+    grouper_client = SimpleNamespace(GrouperClient=Mock(return_value=grouper))
+    with patch("user_management.grouper_user_management_client.importlib") as mock_importlib:
+        mock_importlib.import_module.return_value = grouper_client
+        return UserManagementClient()
+
+
+class ConfigureSessionTests(SimpleTestCase):
+    def test_client_without_session_attribute_left_alone(self):
+        grouper = SimpleNamespace()
+        with self.assertLogs("user_management.grouper_user_management_client", level="WARNING"):
+            build_client(grouper)
+        assert not hasattr(grouper, "session")
+
+    def test_unset_session_replaced_with_shared_session(self):
+        grouper = SimpleNamespace(session=None)
+        build_client(grouper)
+        assert grouper.session is _shared_session()
+
+    def test_own_session_kept(self):
+        session = requests.Session()
+        grouper = SimpleNamespace(session=session)
+        build_client(grouper)
+        assert grouper.session is session
+        assert session.get_adapter("https://grouper.example.edu").poolmanager.connection_pool_kw["maxsize"] == 32
+
+
+class GroupMembersTests(SimpleTestCase):
+    def test_failed_page_fails_whole_lookup(self):
+        def iter_group_members(group):
+            yield {"1": "alice"}
+            raise IOError("connection reset")
+
+        client = build_client(SimpleNamespace(session=None, iter_group_members=iter_group_members))
+        with self.assertRaises(IOError), self.assertLogs("user_management.grouper_user_management_client", "ERROR"):
+            client.get_group_members("group1")
+
+
+class GroupsExistTests(SimpleTestCase):
+    def test_groups_looked_up_one_at_a_time(self):
+        grouper = SimpleNamespace(session=None, group_exists=Mock(side_effect=lambda group: group == "group1"))
+        client = build_client(grouper)
+        assert client.groups_exist(["group1", "group2"]) == {"group1": True, "group2": False}
+        assert client.groups_exist(["group1", "group2"]) == {"group1": True, "group2": False}
+        assert grouper.group_exists.call_count == 2
+
+    def test_failed_lookup_leaves_group_out(self):
+        def group_exists(group):
+            if group == "group2":
+                raise IOError("unavailable")
+            return True
+
+        client = build_client(SimpleNamespace(session=None, group_exists=Mock(side_effect=group_exists)))
+        with self.assertLogs("user_management.grouper_user_management_client", "ERROR"):
+            assert client.groups_exist(["group1", "group2"]) == {"group1": True}
+
+    def test_add_rechecks_groups_after_failed_lookup(self):
+        grouper = SimpleNamespace(
+            session=None,
+            group_exists=Mock(side_effect=[IOError("unavailable"), True]),
+            get_group_members=Mock(return_value={}),
+            add_members_to_group=Mock(),
+            create_group=Mock(),
+        )
+        client = build_client(grouper)
+        with self.assertLogs("user_management.grouper_user_management_client", "ERROR"):
+            add_user_to_group_set("alice", {"group1"}, client=client)
+        assert grouper.group_exists.call_count == 2
+        grouper.create_group.assert_not_called()
+        grouper.add_members_to_group.assert_called_once_with("group1", ["alice"])
+
+
+@override_settings(USER_MANAGEMENT_SYNC_CONCURRENCY=1)
+class UnavailableGrouperTests(SimpleTestCase):
+    def build_grouper(self, **methods):
+        return SimpleNamespace(
+            session=None,
+            group_exists=Mock(return_value=True),
+            get_group_members=Mock(return_value={"1": "alice"}),
+            **methods,
+        )
+
+    def test_connection_failure_skips_remaining_groups(self):
+        grouper = self.build_grouper(
+            remove_members_from_group=Mock(side_effect=requests.exceptions.ConnectionError("connection refused"))
+        )
+        client = build_client(grouper)
+        error_callback = Mock()
+        with self.assertLogs("user_management", "ERROR"):
+            remove_user_from_group_set(
+                "alice", {"group1", "group2", "group3"}, error_callback, callback_args=(7,), client=client
+            )
+        grouper.remove_members_from_group.assert_called_once()
+        error_callback.assert_called_once_with(7)
+
+    def test_refused_request_skips_remaining_groups(self):
+        refused = requests.exceptions.HTTPError("forbidden", response=SimpleNamespace(status_code=403))
+        grouper = self.build_grouper(add_members_to_group=Mock(side_effect=refused))
+        client = build_client(grouper)
+        with self.assertLogs("user_management", "ERROR"):
+            add_user_to_group_set("bob", {"group1", "group2", "group3"}, client=client)
+        grouper.add_members_to_group.assert_called_once()
+
+    def test_other_failures_handled_per_group(self):
+        grouper = self.build_grouper(remove_members_from_group=Mock(side_effect=IOError("group is read only")))
+        client = build_client(grouper)
+        with self.assertLogs("user_management", "ERROR"):
+            remove_user_from_group_set("alice", {"group1", "group2", "group3"}, client=client)
+        # the failure is specific to the group, so the other groups are still tried
+        assert grouper.remove_members_from_group.call_count == 3
@@ -0,0 +1,174 @@
+import csv
+import json
+import os
+import tempfile
+
+from coldfront.core.allocation.models import AllocationAttribute, AllocationAttributeType, AllocationStatusChoice
+from coldfront.core.allocation.models import AttributeType as AllocationAttributeDataType
+from coldfront.core.project.models import AttributeType, ProjectAttribute, ProjectAttributeType, ProjectStatusChoice
+from coldfront.core.test_helpers.factories import AllocationFactory, ProjectFactory, ResourceFactory, UserFactory
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+
+
+class LoadGroupsTestCase(TestCase):
+    alignment = None
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.input_file = os.path.join(directory.name, "groups.csv")
+        self.json_output_file = os.path.join(directory.name, "differences.json")
+        self.csv_output_file = os.path.join(directory.name, "differences.csv")
+
+    def write_input(self, rows):
+        with open(self.input_file, mode="w", encoding="utf-8", newline="") as file:
+            writer = csv.DictWriter(file, fieldnames=["project", "pi_username", "allocation_id", "group"])
+            writer.writeheader()
+            writer.writerows(rows)
+
+    def load_groups(self, rows, dry_run=True):
+        self.write_input(rows)
+        args = ["load_groups", "-a", self.alignment, "-i", self.input_file, "-o", self.json_output_file]
+        call_command(*args, *(["-d"] if dry_run else []))
+        with open(self.json_output_file, encoding="utf-8") as file:
+            return json.load(file)
+
+    def load_groups_to_csv(self, rows):
+        self.write_input(rows)
+        call_command("load_groups", "-a", self.alignment, "-i", self.input_file, "-o", self.csv_output_file)
+        with open(self.csv_output_file, encoding="utf-8", newline="") as file:
+            return list(csv.DictReader(file))
+
+
+@override_settings(UNIX_GROUP_ATTRIBUTE_NAME="ad_group", MANAGE_GROUPS_AT_PROJECT_LEVEL=True)
+class LoadProjectGroupsTests(LoadGroupsTestCase):
+    alignment = "project"
+
+    def setUp(self):
+        super().setUp()
+        self.status = ProjectStatusChoice.objects.get_or_create(name="Active")[0]
+        self.attribute_type = ProjectAttributeType.objects.create(
+            name="ad_group", attribute_type=AttributeType.objects.get_or_create(name="Text")[0]
+        )
+
+    def build_rows(self):
+        """Creates projects whose group is unchanged, changed and missing, and returns an input row for each."""
+        self.projects = [ProjectFactory(title=f"project{i}", status=self.status) for i in range(3)]
+        ProjectAttribute.objects.create(project=self.projects[0], proj_attr_type=self.attribute_type, value="same")
+        ProjectAttribute.objects.create(project=self.projects[1], proj_attr_type=self.attribute_type, value="old")
+        groups = ["same", "new", "added"]
+        return [
+            {"project": project.title, "pi_username": project.pi.username, "allocation_id": "", "group": group}
+            for project, group in zip(self.projects, groups)
+        ] + [{"project": "missing", "pi_username": "nobody", "allocation_id": "", "group": "other"}]
+
+    @staticmethod
+    def mapping_key(row):
+        return f"{row['project']}_{row['pi_username']}".lower()
+
+    def group_attribute(self, project):
+        return ProjectAttribute.objects.get(project=project, proj_attr_type=self.attribute_type)
+
+    def test_mixed_case_title_matched(self):
+        project = ProjectFactory(title="ÉCOLE_Smith_Lab", pi=UserFactory(username="JSmith"), status=self.status)
+        differences = self.load_groups(
+            [{"project": project.title.lower(), "pi_username": "jsmith", "allocation_id": "", "group": "smith_lab"}]
+        )
+        assert [d["mapping_key"] for d in differences["added"]] == ["école_smith_lab_jsmith"]
+        assert differences["skipped"] == []
+
+    def test_groups_written(self):
+        rows = self.build_rows()
+        differences = self.load_groups(rows, dry_run=False)
+        assert [self.group_attribute(project).value for project in self.projects] == ["same", "new", "added"]
+        assert [(d["group"], d["new_group"]) for d in differences["updated"]] == [("old", "new")]
+        assert [(d["group"], d["new_group"]) for d in differences["added"]] == [("", "added")]
+        assert sorted(d["mapping_key"] for d in differences["skipped"]) == sorted(
+            self.mapping_key(row) for row in (rows[0], rows[3])
+        )
+
+    def test_history_recorded(self):
+        rows = self.build_rows()
+        modified = [self.group_attribute(project).modified for project in self.projects[:2]]
+        self.load_groups(rows, dry_run=False)
+        unchanged, updated, created = (self.group_attribute(project) for project in self.projects)
+        assert unchanged.modified == modified[0]
+        assert updated.modified > modified[1]
+        assert list(unchanged.history.values_list("history_type", flat=True)) == ["+"]
+        assert list(updated.history.values_list("history_type", "value")) == [("~", "new"), ("+", "old")]
+        assert list(created.history.values_list("history_type", "value")) == [("+", "added")]
+
+    def test_differences_written_to_csv(self):
+        rows = self.build_rows()
+        differences = self.load_groups_to_csv(rows)
+        by_key = {d["mapping_key"]: d for d in differences}
+        keys = [self.mapping_key(row) for row in rows]
+        assert [by_key[key]["action"] for key in keys] == ["skipped", "updated", "added", "skipped"]
+        assert (by_key[keys[1]]["group"], by_key[keys[1]]["new_group"]) == ("old", "new")
+        assert (by_key[keys[2]]["group"], by_key[keys[2]]["new_group"]) == ("", "added")
+        assert self.group_attribute(self.projects[2]).value == "added"
+
+    def test_dry_run_writes_nothing(self):
+        differences = self.load_groups(self.build_rows())
+        assert len(differences["added"]) == 1
+        assert not ProjectAttribute.objects.filter(project=self.projects[2]).exists()
+        assert self.group_attribute(self.projects[1]).value == "old"
+
+
+@override_settings(UNIX_GROUP_ATTRIBUTE_NAME="ad_group", MANAGE_GROUPS_AT_PROJECT_LEVEL=False)
+class LoadAllocationGroupsTests(LoadGroupsTestCase):
+    alignment = "allocation"
+
+    def setUp(self):
+        super().setUp()
+        status = AllocationStatusChoice.objects.get_or_create(name="Active")[0]
+        self.attribute_type = AllocationAttributeType.objects.create(
+            name="ad_group", attribute_type=AllocationAttributeDataType.objects.get_or_create(name="Text")[0]
+        )
+        self.allocations = [AllocationFactory(status=status) for _ in range(3)]
+        for i, allocation in enumerate(self.allocations):
+            allocation.resources.add(ResourceFactory(name=f"resource{i}"))
+        AllocationAttribute.objects.create(
+            allocation=self.allocations[0], allocation_attribute_type=self.attribute_type, value="same"
+        )
+        AllocationAttribute.objects.create(
+            allocation=self.allocations[1], allocation_attribute_type=self.attribute_type, value="old"
+        )
+        groups = ["same", "new", "added"]
+        self.rows = [
+            {"project": "", "pi_username": "", "allocation_id": str(allocation.pk), "group": group}
+            for allocation, group in zip(self.allocations, groups)
+        ]
+
+    def group_attribute(self, allocation):
+        return AllocationAttribute.objects.get(allocation=allocation, allocation_attribute_type=self.attribute_type)
+
+    def test_groups_written(self):
+        differences = self.load_groups(self.rows, dry_run=False)
+        assert [self.group_attribute(allocation).value for allocation in self.allocations] == ["same", "new", "added"]
+        assert [(d["allocation_id"], d["group"], d["new_group"]) for d in differences["updated"]] == [
+            (self.allocations[1].pk, "old", "new")
+        ]
+        assert [(d["allocation"], d["new_group"]) for d in differences["added"]] == [("resource2", "added")]
+        assert [d["allocation_id"] for d in differences["skipped"]] == [self.allocations[0].pk]
+
+    def test_history_recorded(self):
+        rows = self.rows
+        modified = [self.group_attribute(allocation).modified for allocation in self.allocations[:2]]
+        self.load_groups(rows, dry_run=False)
+        unchanged, updated, created = (self.group_attribute(allocation) for allocation in self.allocations)
+        assert unchanged.modified == modified[0]
+        assert updated.modified > modified[1]
+        assert list(unchanged.history.values_list("history_type", flat=True)) == ["+"]
+        assert list(updated.history.values_list("history_type", "value")) == [("~", "new"), ("+", "old")]
+        assert list(created.history.values_list("history_type", "value")) == [("+", "added")]
+
+    def test_differences_written_to_csv(self):
+        differences = self.load_groups_to_csv(self.rows)
+        by_id = {d["allocation_id"]: d for d in differences}
+        ids = [row["allocation_id"] for row in self.rows]
+        assert [by_id[allocation_id]["action"] for allocation_id in ids] == ["skipped", "updated", "added"]
+        assert (by_id[ids[1]]["group"], by_id[ids[1]]["new_group"]) == ("old", "new")
+        assert by_id[ids[2]]["allocation"] == "resource2"
+        assert self.group_attribute(self.allocations[2]).value == "added"
@@ -1,22 +1,24 @@
-from unittest.mock import patch
+from unittest.mock import ANY, patch
 
 from coldfront.core.test_helpers.factories import ProjectFactory, ProjectUserFactory, UserFactory
-from django.test import TestCase, override_settings
+from django.test import SimpleTestCase, TestCase, override_settings
 
 from user_management.tasks import (
     add_project_user_to_group,
     remove_all_project_users_from_groups,
     remove_project_user_from_group,
 )
+from user_management.tests.helpers import UserManagementClient
 from user_management.utils import set_project_user_status_to_pending
 
 
 @override_settings(USER_MANAGEMENT_CLIENT_PATH="user_management/tests/helpers.py")
 @override_settings(UNIX_GROUP_ATTRIBUTE_NAME="ad_group")
-class AddProjectUserToGroupTests(TestCase):
+class AddProjectUserToGroupTests(SimpleTestCase):
     def setUp(self):
-        self.project_user = ProjectUserFactory()
+        self.project_user = ProjectUserFactory.build()
         self.project_user.user.username = "testuser"
+        self.project_user.pk = 1
 
     @patch("user_management.tasks.ProjectUser")
     @patch("user_management.utils.get_project_attribute_values_set")
@@ -25,18 +27,22 @@ class AddProjectUserToGroupTests(TestCase):
         self.project_user.status.name = "Active"
         self.project_user.project.status.name = "Active"
         mock_get_project_attribute_values_set.return_value = {"group1", "group2"}
-        mock_project_user.objects.get.return_value = self.project_user
+        mock_project_user.objects.select_related.return_value.get.return_value = self.project_user
         mock_add_user_to_group_set.return_value = None
         add_project_user_to_group(mock_project_user.pk)
         mock_add_user_to_group_set.assert_called_once_with(
-            "testuser", {"group1", "group2"}, error_callback=set_project_user_status_to_pending
+            "testuser",
+            {"group1", "group2"},
+            error_callback=set_project_user_status_to_pending,
+            callback_args=(self.project_user.pk,),
+            client=None,
         )
 
     @patch("user_management.tasks.ProjectUser")
     @patch("user_management.tasks.logger")
     def test_project_not_active(self, mock_logger, mock_project_user):
         self.project_user.project.status.name = "Archived"
-        mock_project_user.objects.get.return_value = self.project_user
+        mock_project_user.objects.select_related.return_value.get.return_value = self.project_user
         add_project_user_to_group(mock_project_user.pk)
         mock_logger.warning.assert_called_with("Project is not active. Will not add user")
 
@@ -45,7 +51,7 @@ class AddProjectUserToGroupTests(TestCase):
     def test_user_status_not_active(self, mock_logger, mock_project_user):
         self.project_user.project.status.name = "Active"
         self.project_user.status.name = "Removed"
-        mock_project_user.objects.get.return_value = self.project_user
+        mock_project_user.objects.select_related.return_value.get.return_value = self.project_user
         add_project_user_to_group(mock_project_user.pk)
         mock_logger.warning.assert_called_with("Project user status is not 'Active'. Will not add user.")
 
@@ -56,42 +62,52 @@ class AddProjectUserToGroupTests(TestCase):
         self.project_user.status.name = "Active"
         self.project_user.project.status.name = "Active"
         mock_get_project_attribute_values_set.return_value = set()
-        mock_project_user.objects.get.return_value = self.project_user
+        mock_project_user.objects.select_related.return_value.get.return_value = self.project_user
         add_project_user_to_group(mock_project_user.pk)
         mock_logger.info.assert_called_with("Project does not have any groups. Nothing to add")
 
 
 @override_settings(USER_MANAGEMENT_CLIENT_PATH="user_management/tests/helpers.py")
 @override_settings(UNIX_GROUP_ATTRIBUTE_NAME="ad_group")
-class RemoveProjectUserFromGroupTests(TestCase):
+class RemoveProjectUserFromGroupTests(SimpleTestCase):
     def setUp(self):
-        self.project_user = ProjectUserFactory()
+        self.project_user = ProjectUserFactory.build()
         self.project_user.user.username = "testuser"
+        self.project_user.pk = 1
 
     @patch("user_management.utils.remove_user_from_group_set")
     @patch("user_management.utils.get_project_attribute_values_set")
     @patch("user_management.utils.collect_other_project_user_groups")
     @patch("user_management.tasks.ProjectUser")
-    def test_success(self, mock_project_user, mock_collect_other_project_user_groups, 
-                     mock_get_project_attribute_values_set, mock_remove_user_from_group_set):
+    def test_success(
+        self,
+        mock_project_user,
+        mock_collect_other_project_user_groups,
+        mock_get_project_attribute_values_set,
+        mock_remove_user_from_group_set,
+    ):
         self.project_user.status.name = "Removed"
         self.project_user.project.status.name = "Active"
         mock_get_project_attribute_values_set.return_value = {"group1", "group2"}
-        mock_project_user.objects.get.return_value = self.project_user
+        mock_project_user.objects.select_related.return_value.get.return_value = self.project_user
         mock_collect_other_project_user_groups.return_value = set()
         remove_project_user_from_group(mock_project_user.pk)
         mock_collect_other_project_user_groups.assert_called_once_with(
-            self.project_user.user, "ad_group", self.project_user.project.pk
+            self.project_user.user, "ad_group", self.project_user.project.pk, candidate_groups={"group1", "group2"}
         )
         mock_remove_user_from_group_set.assert_called_once_with(
-            "testuser", {"group1", "group2"}, error_callback=set_project_user_status_to_pending
+            "testuser",
+            {"group1", "group2"},
+            error_callback=set_project_user_status_to_pending,
+            callback_args=(self.project_user.pk,),
+            client=None,
         )
 
     @patch("user_management.tasks.ProjectUser")
     @patch("user_management.tasks.logger")
     def test_project_not_active(self, mock_logger, mock_project_user):
         self.project_user.project.status.name = "Archived"
-        mock_project_user.objects.get.return_value = self.project_user
+        mock_project_user.objects.select_related.return_value.get.return_value = self.project_user
         remove_project_user_from_group(mock_project_user.pk)
         mock_logger.warning.assert_called_with("Project is archived. Will not remove user from group")
 
@@ -100,17 +116,18 @@ class RemoveProjectUserFromGroupTests(TestCase):
     def test_user_status_not_removed(self, mock_logger, mock_project_user):
         self.project_user.project.status.name = "Active"
         self.project_user.status.name = "Active"
-        mock_project_user.objects.get.return_value = self.project_user
+        mock_project_user.objects.select_related.return_value.get.return_value = self.project_user
         remove_project_user_from_group(mock_project_user.pk)
         mock_logger.warning.assert_called_with("Project user status is not 'Removed'. Will not remove user from group.")
 
     @patch("user_management.tasks.ProjectUser")
+    @patch("user_management.utils.get_project_attribute_values_set")
     @patch("user_management.tasks.logger")
-    def test_no_groups(self, mock_logger, mock_project_user):
+    def test_no_groups(self, mock_logger, mock_get_project_attribute_values_set, mock_project_user):
         self.project_user.status.name = "Removed"
         self.project_user.project.status.name = "Active"
-        self.project_user.project.get_attribute_list = lambda group_attr_name: []
-        mock_project_user.objects.get.return_value = self.project_user
+        mock_get_project_attribute_values_set.return_value = set()
+        mock_project_user.objects.select_related.return_value.get.return_value = self.project_user
         remove_project_user_from_group(mock_project_user.pk)
         mock_logger.info.assert_called_with("Project does not have any groups. Nothing to remove")
 
@@ -118,36 +135,140 @@ class RemoveProjectUserFromGroupTests(TestCase):
 @override_settings(USER_MANAGEMENT_CLIENT_PATH="user_management/tests/helpers.py")
 @override_settings(UNIX_GROUP_ATTRIBUTE_NAME="ad_group")
 class RemoveAllUsersFromProjectGroupsTests(TestCase):
-    def setUp(self):
-        self.project = ProjectFactory()
-        self.project.pi.username = "piuser"
-        self.project_user1 = ProjectUserFactory(project=self.project, user=UserFactory(username="user1"))
-        self.project_user2 = ProjectUserFactory(project=self.project, user=UserFactory(username="user2"))
-        self.project_user3 = ProjectUserFactory(project=self.project, user=UserFactory(username="user3"))
+    @classmethod
+    def setUpTestData(cls):
+        cls.project = ProjectFactory()
+        cls.project.pi.username = "piuser"
+        cls.project_user1 = ProjectUserFactory(project=cls.project, user=UserFactory(username="user1"))
+        cls.project_user2 = ProjectUserFactory(project=cls.project, user=UserFactory(username="user2"))
+        cls.project_user3 = ProjectUserFactory(project=cls.project, user=UserFactory(username="user3"))
 
     @patch("user_management.utils.remove_user_from_group_set")
     @patch("user_management.utils.get_project_attribute_values_set")
-    @patch("user_management.utils.collect_other_project_user_groups")
+    @patch("user_management.utils.collect_other_project_user_groups_bulk")
     @patch("user_management.tasks.Project")
-    def test_success(self, mock_project, mock_collect_other_project_user_groups, 
-                     mock_get_project_attribute_values_set, mock_remove_user_from_group_set):
+    def test_success(
+        self,
+        mock_project,
+        mock_collect_other_project_user_groups_bulk,
+        mock_get_project_attribute_values_set,
+        mock_remove_user_from_group_set,
+    ):
         self.project.status.name = "Archived"
         mock_get_project_attribute_values_set.return_value = {"group1", "group2"}
         mock_project.objects.get.return_value = self.project
-        mock_collect_other_project_user_groups.return_value = set()
+        mock_collect_other_project_user_groups_bulk.return_value = {}
         remove_all_project_users_from_groups(self.project.pk)
-        self.assertEqual(mock_collect_other_project_user_groups.call_count, 4)  # 3 users + 1 PI
+        # one lookup for the 3 users and the PI
+        mock_collect_other_project_user_groups_bulk.assert_called_once()
+        self.assertEqual(len(mock_collect_other_project_user_groups_bulk.call_args.args[0]), 4)
         self.assertEqual(mock_remove_user_from_group_set.call_count, 4)
         mock_remove_user_from_group_set.assert_any_call(
-            "user1", {"group1", "group2"}, error_callback=set_project_user_status_to_pending
+            "user1",
+            {"group1", "group2"},
+            error_callback=set_project_user_status_to_pending,
+            callback_args=(self.project_user1.pk,),
+            client=ANY,
+            max_workers=1,
         )
         mock_remove_user_from_group_set.assert_any_call(
-            "user2", {"group1", "group2"}, error_callback=set_project_user_status_to_pending
+            "user2",
+            {"group1", "group2"},
+            error_callback=set_project_user_status_to_pending,
+            callback_args=(self.project_user2.pk,),
+            client=ANY,
+            max_workers=1,
         )
         mock_remove_user_from_group_set.assert_any_call(
-            "user3", {"group1", "group2"}, error_callback=set_project_user_status_to_pending
+            "user3",
+            {"group1", "group2"},
+            error_callback=set_project_user_status_to_pending,
+            callback_args=(self.project_user3.pk,),
+            client=ANY,
+            max_workers=1,
+        )
+        mock_remove_user_from_group_set.assert_any_call("piuser", {"group1", "group2"}, client=ANY, max_workers=1)
+        # the removals share one client
+        clients = {id(call.kwargs["client"]) for call in mock_remove_user_from_group_set.call_args_list}
+        self.assertEqual(len(clients), 1)
+
+    @patch("user_management.utils.remove_user_from_group_set")
+    @patch("user_management.utils.get_project_attribute_values_set")
+    @patch("user_management.utils.collect_other_project_user_groups_bulk")
+    @patch("user_management.tasks.Project")
+    def test_pi_project_user_removed_once(
+        self,
+        mock_project,
+        mock_collect_other_project_user_groups_bulk,
+        mock_get_project_attribute_values_set,
+        mock_remove_user_from_group_set,
+    ):
+        ProjectUserFactory(project=self.project, user=self.project.pi)
+        self.project.status.name = "Archived"
+        mock_get_project_attribute_values_set.return_value = {"group1"}
+        mock_project.objects.get.return_value = self.project
+        mock_collect_other_project_user_groups_bulk.return_value = {}
+        remove_all_project_users_from_groups(self.project.pk)
+        removed = [c.args[0] for c in mock_remove_user_from_group_set.call_args_list]
+        # the 3 users and the PI, each removed once
+        self.assertEqual(len(removed), 4)
+        self.assertEqual(len(set(removed)), 4)
+
+    @patch("user_management.utils.set_project_user_status_to_pending")
+    @patch("user_management.utils.get_client")
+    @patch("user_management.utils.get_project_attribute_values_set")
+    @patch("user_management.utils.collect_other_project_user_groups_bulk")
+    @patch("user_management.tasks.Project")
+    def test_failed_removal_sets_project_user_pending(
+        self,
+        mock_project,
+        mock_collect_other_project_user_groups_bulk,
+        mock_get_project_attribute_values_set,
+        mock_get_client,
+        mock_set_project_user_status_to_pending,
+    ):
+        client = UserManagementClient()
+        for username in ("user1", "user2", "user3", self.project.pi.username):
+            client.add_user_to_group(username, "group1")
+        mock_get_client.return_value = client
+        self.project.status.name = "Archived"
+        mock_get_project_attribute_values_set.return_value = {"group1"}
+        mock_project.objects.get.return_value = self.project
+        mock_collect_other_project_user_groups_bulk.return_value = {}
+        with patch.object(client, "remove_user_from_group", side_effect=IOError("unavailable")):
+            remove_all_project_users_from_groups(self.project.pk)
+        # each project user is marked pending; the PI has no callback
+        self.assertCountEqual(
+            [c.args for c in mock_set_project_user_status_to_pending.call_args_list],
+            [(self.project_user1.pk,), (self.project_user2.pk,), (self.project_user3.pk,)],
         )
-        mock_remove_user_from_group_set.assert_any_call("piuser", {"group1", "group2"})
+
+    @patch("user_management.utils.ThreadPoolExecutor")
+    @patch("user_management.utils.get_client")
+    @patch("user_management.utils.get_project_attribute_values_set")
+    @patch("user_management.utils.collect_other_project_user_groups_bulk")
+    @patch("user_management.tasks.Project")
+    def test_each_users_groups_removed_serially(
+        self,
+        mock_project,
+        mock_collect_other_project_user_groups_bulk,
+        mock_get_project_attribute_values_set,
+        mock_get_client,
+        mock_group_executor,
+    ):
+        client = UserManagementClient()
+        for username in ("user1", "user2", "user3", self.project.pi.username):
+            for group in ("group1", "group2"):
+                client.add_user_to_group(username, group)
+        mock_get_client.return_value = client
+        self.project.status.name = "Archived"
+        mock_get_project_attribute_values_set.return_value = {"group1", "group2"}
+        mock_project.objects.get.return_value = self.project
+        mock_collect_other_project_user_groups_bulk.return_value = {}
+        remove_all_project_users_from_groups(self.project.pk)
+        # the users are already removed concurrently, so no pool is started per user
+        mock_group_executor.assert_not_called()
+        assert client.groups == {"group1": set(), "group2": set()}
 
     @patch("user_management.tasks.Project")
     @patch("user_management.tasks.logger")
@@ -169,20 +290,23 @@ class RemoveAllUsersFromProjectGroupsTests(TestCase):
 
     @patch("user_management.utils.remove_user_from_group_set")
     @patch("user_management.utils.get_project_attribute_values_set")
-    @patch("user_management.utils.collect_other_project_user_groups")
+    @patch("user_management.utils.collect_other_project_user_groups_bulk")
     @patch("user_management.tasks.Project")
     def test_no_groups_to_remove(
-        self, mock_project, mock_collect_other_project_user_groups, 
-        mock_get_project_attribute_values_set, 
-        mock_remove_user_from_group_set
+        self,
+        mock_project,
+        mock_collect_other_project_user_groups_bulk,
+        mock_get_project_attribute_values_set,
+        mock_remove_user_from_group_set,
     ):
         self.project.status.name = "Archived"
         mock_get_project_attribute_values_set.return_value = {"group1", "group2"}
         mock_project.objects.get.return_value = self.project
-        mock_collect_other_project_user_groups.return_value = {
-            "group1",
-            "group2",
+        users = [self.project_user1.user, self.project_user2.user, self.project_user3.user, self.project.pi]
+        mock_collect_other_project_user_groups_bulk.return_value = {
+            user.pk: {"group1", "group2"} for user in users
         }  # all users belong to both groups in other active projects
         remove_all_project_users_from_groups(self.project.pk)
-        self.assertEqual(mock_collect_other_project_user_groups.call_count, 4)  # 3 users + 1 PI
+        # one lookup for the 3 users and the PI
+        mock_collect_other_project_user_groups_bulk.assert_called_once()
         mock_remove_user_from_group_set.assert_not_called()
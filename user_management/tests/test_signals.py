@@ -0,0 +1,51 @@
+from unittest.mock import patch
+
+from coldfront.core.allocation.signals import allocation_activate_user, allocation_remove_user
+from django.core.signals import request_finished, request_started
+from django.test import TestCase
+
+from user_management.signals import init_signal_receivers
+
+
+class AllocationSignalReceiverTests(TestCase):
+    def setUp(self):
+        init_signal_receivers(project_level=False, remove_on_archive=False)
+
+    def tearDown(self):
+        allocation_activate_user.disconnect(dispatch_uid="ump_activate_allocation_user_1")
+        allocation_remove_user.disconnect(dispatch_uid="ump_remove_allocation_user_1")
+        request_started.disconnect(dispatch_uid="ump_start_user_task_batch")
+        request_finished.disconnect(dispatch_uid="ump_flush_user_task_batch")
+
+    @patch("django_q.tasks.async_task")
+    def test_activate_enqueues_one_task(self, mock_async_task):
+        allocation_activate_user.send(sender=self.__class__, allocation_user_pk=1)
+        mock_async_task.assert_called_once_with("user_management.tasks.add_allocation_user_to_group", 1, save=False)
+
+    @patch("django_q.tasks.async_task")
+    def test_remove_enqueues_one_task(self, mock_async_task):
+        allocation_remove_user.send(sender=self.__class__, allocation_user_pk=1)
+        mock_async_task.assert_called_once_with(
+            "user_management.tasks.remove_allocation_user_from_group", 1, save=False
+        )
+
+    @patch("django_q.tasks.async_task")
+    def test_request_enqueues_one_task_for_all_users(self, mock_async_task):
+        request_started.send(sender=self.__class__)
+        for user_pk in (1, 2, 3):
+            allocation_activate_user.send(sender=self.__class__, allocation_user_pk=user_pk)
+        mock_async_task.assert_not_called()
+        request_finished.send(sender=self.__class__)
+        mock_async_task.assert_called_once_with(
+            "user_management.tasks.run_user_tasks", "add_allocation_user_to_group", [1, 2, 3], save=False
+        )
+
+    @patch("django_q.tasks.async_task")
+    def test_request_enqueues_each_user_once(self, mock_async_task):
+        request_started.send(sender=self.__class__)
+        for user_pk in (2, 1, 2):
+            allocation_activate_user.send(sender=self.__class__, allocation_user_pk=user_pk)
+        request_finished.send(sender=self.__class__)
+        mock_async_task.assert_called_once_with(
+            "user_management.tasks.run_user_tasks", "add_allocation_user_to_group", [2, 1], save=False
+        )
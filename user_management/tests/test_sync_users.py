@@ -0,0 +1,125 @@
+from coldfront.core.test_helpers.factories import (
+    AllocationAttributeFactory,
+    AllocationAttributeTypeFactory,
+    AllocationFactory,
+    AllocationUserFactory,
+    PAttributeTypeFactory,
+    ProjectAttributeFactory,
+    ProjectAttributeTypeFactory,
+    ProjectFactory,
+    ProjectStatusChoiceFactory,
+    ProjectUserFactory,
+    ResourceFactory,
+)
+from django.test import TestCase, override_settings
+
+from user_management.management.commands.sync_users import Command
+from user_management.tests.helpers import UserManagementClient
+
+
+@override_settings(USER_MANAGEMENT_CLIENT_PATH="user_management/tests/helpers.py")
+@override_settings(UNIX_GROUP_ATTRIBUTE_NAME="ad_group")
+class CollateProjectUserDataTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        active = ProjectStatusChoiceFactory(name="Active")
+        group_attribute_type = ProjectAttributeTypeFactory(
+            name="ad_group", attribute_type=PAttributeTypeFactory(name="Text")
+        )
+        cls.projects = []
+        for i in range(2):
+            project = ProjectFactory(title=f"project{i}", status=active)
+            ProjectAttributeFactory(project=project, proj_attr_type=group_attribute_type, value=f"group{i}")
+            ProjectUserFactory(project=project)
+            cls.projects.append(project)
+
+    def test_collates_every_project(self):
+        result = Command().collate_project_user_data("ad_group", include_new=False)
+        assert len(result) == 2
+        entries = {entry["project_id"]: entry for entry in result}
+        for i, project in enumerate(self.projects):
+            assert entries[project.pk]["groups"] == [f"group{i}"]
+            # the active project user and the PI
+            assert len(entries[project.pk]["users"]) == 2
+            assert project.pi.username in entries[project.pk]["users"]
+
+
+@override_settings(USER_MANAGEMENT_CLIENT_PATH="user_management/tests/helpers.py")
+@override_settings(UNIX_GROUP_ATTRIBUTE_NAME="ad_group")
+class CollateAllocationUserDataTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        group_attribute_type = AllocationAttributeTypeFactory(name="ad_group")
+        cls.allocations = []
+        for i in range(2):
+            allocation = AllocationFactory()
+            allocation.resources.add(ResourceFactory(name=f"resource{i}"))
+            AllocationAttributeFactory(
+                allocation=allocation, allocation_attribute_type=group_attribute_type, value=f"group{i}"
+            )
+            AllocationUserFactory(allocation=allocation)
+            cls.allocations.append(allocation)
+
+    def test_collates_every_allocation(self):
+        result = Command().collate_allocation_user_data("ad_group", include_new=False)
+        assert len(result) == 2
+        entries = {entry["allocation_id"]: entry for entry in result}
+        for i, allocation in enumerate(self.allocations):
+            assert entries[allocation.pk]["groups"] == [f"group{i}"]
+            assert len(entries[allocation.pk]["users"]) == 1
+
+
+class CollateExternalUserDataTests(TestCase):
+    def test_queries_every_group(self):
+        client = UserManagementClient()
+        client.add_users_to_group(["user1", "user2"], "group1")
+        client.add_users_to_group(["user3"], "group2")
+        result = Command().collate_external_user_data({"group1", "group2", "missing"}, client)
+        entries = {entry["group"]: entry for entry in result}
+        assert sorted(entries["group1"]["members"]) == ["user1", "user2"]
+        assert list(entries["group2"]["members"]) == ["user3"]
+        assert entries["missing"]["members"] == []
+        assert entries["missing"]["errors"] == ["Group missing does not exist in external system."]
+
+
+@override_settings(MANAGE_GROUPS_AT_PROJECT_LEVEL=True)
+class CompareColdfrontToExternalTests(TestCase):
+    coldfront = [{"project": "project0", "project_id": 1, "groups": ["group0"], "users": frozenset({"user1", "user2"})}]
+    external = [{"group": "group0", "members": ["user2", "user3"], "errors": []}]
+
+    def test_finds_differences(self):
+        result = Command().compare_coldfront_to_external(self.coldfront, self.external)
+        assert len(result) == 1
+        assert result[0]["project"] == "project0"
+        assert result[0]["missing_from_external"] == ["user1"]
+        assert result[0]["missing_from_coldfront"] == ["user3"]
+
+    def test_username_filter(self):
+        result = Command().compare_coldfront_to_external(self.coldfront, self.external, "user3")
+        assert len(result) == 1
+        assert result[0]["missing_from_external"] == []
+        assert result[0]["missing_from_coldfront"] == ["user3"]
+        assert Command().compare_coldfront_to_external(self.coldfront, self.external, "user2") == []
+
+
+class GroupDifferencesByTargetTests(TestCase):
+    def test_merges_differences_per_target(self):
+        differences = [
+            {
+                "alignment": "project",
+                "project": "project0",
+                "project_id": 1,
+                "group": group,
+                "missing_from_external": missing_from_external,
+                "missing_from_coldfront": missing_from_coldfront,
+                "errors": errors,
+            }
+            for group, missing_from_external, missing_from_coldfront, errors in [
+                ("group0", ["user1"], ["user3"], []),
+                ("group1", ["user2"], ["user4"], []),
+                ("group2", ["user5"], [], ["Group group2 does not exist in external system."]),
+            ]
+        ]
+        targets = Command().group_differences_by_target(differences)
+        assert list(targets) == [1]
+        assert targets[1] == {"name": "project0", "add": {"user3", "user4"}, "remove": {"user1", "user2"}}
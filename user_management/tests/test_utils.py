@@ -1,13 +1,46 @@
+import threading
+import types
+from pathlib import Path
+from unittest.mock import Mock, patch
+
 import pytest
-from django.test import TestCase
+from coldfront.core.test_helpers.factories import (
+    AAttributeTypeFactory,
+    AllocationAttributeFactory,
+    AllocationAttributeTypeFactory,
+    AllocationFactory,
+    AllocationStatusChoiceFactory,
+    AllocationUserFactory,
+    PAttributeTypeFactory,
+    ProjectAttributeFactory,
+    ProjectAttributeTypeFactory,
+    ProjectFactory,
+    ProjectStatusChoiceFactory,
+    ProjectUserFactory,
+    ProjectUserStatusChoiceFactory,
+    UserFactory,
+)
+from django.test import TestCase, override_settings
 
 from user_management.tests.helpers import UserManagementClient
 from user_management.utils import (
+    AddResult,
     AlreadyMemberError,
+    CachingClient,
     GroupDoesNotExistError,
     NotMemberError,
+    RemoveResult,
     _add_user_to_group,
+    _find_client_class,
     _remove_user_from_group,
+    _try_add_user_to_group,
+    _try_remove_user_from_group,
+    add_user_to_group_set,
+    collect_other_allocation_user_groups,
+    collect_other_project_user_groups,
+    collect_other_project_user_groups_bulk,
+    get_client_class,
+    remove_user_from_group_set,
 )
 
 
@@ -24,6 +57,13 @@ class TestUserManagementUtils(TestCase):
         # User should be added
         assert client.user_in_group(user, group)
 
+    def test_add_user_to_new_group_skips_member_check(self):
+        client = UserManagementClient()
+        with patch.object(client, "get_group_members") as mock_get_group_members:
+            _add_user_to_group("alice", "newgroup", client)
+        mock_get_group_members.assert_not_called()
+        assert client.user_in_group("alice", "newgroup")
+
     def test_add_user_to_group_raises_already_member_error(self):
         client = UserManagementClient()
         user = "bob"
@@ -31,8 +71,10 @@ class TestUserManagementUtils(TestCase):
         client.create_group(group)
         client.add_user_to_group(user, group)
         # User is already a member
-        with pytest.raises(AlreadyMemberError):
+        with pytest.raises(AlreadyMemberError) as excinfo:
             _add_user_to_group(user, group, client)
+        assert (excinfo.value.user, excinfo.value.group) == (user, group)
+        assert str(excinfo.value) == "user bob is already a member of group testgroup2"
 
     def test_add_user_to_group_adds_user_to_existing_group(self):
         client = UserManagementClient()
@@ -70,3 +112,235 @@ class TestUserManagementUtils(TestCase):
         # Group does not exist
         with pytest.raises(GroupDoesNotExistError):
             _remove_user_from_group(user, group, client)
+
+    def test_expected_outcomes_returned_without_raising(self):
+        client = UserManagementClient()
+        assert _try_add_user_to_group("grace", "group1", client) is AddResult.ADDED
+        assert _try_add_user_to_group("grace", "group1", client) is AddResult.ALREADY_MEMBER
+        assert _try_remove_user_from_group("grace", "group1", client) is RemoveResult.REMOVED
+        assert _try_remove_user_from_group("grace", "group1", client) is RemoveResult.NOT_MEMBER
+        assert _try_remove_user_from_group("grace", "group2", client) is RemoveResult.GROUP_DOES_NOT_EXIST
+
+
+class MembersOnlyClient(UserManagementClient):
+    # without get_user_groups, membership is checked against each group's members
+    get_user_groups = None
+
+
+class CachingClientTests(TestCase):
+    def test_group_lookups_remembered_across_calls(self):
+        client = MembersOnlyClient()
+        client.create_group("group1")
+        caching_client = CachingClient(client)
+        with (
+            patch.object(client, "groups_exist", wraps=client.groups_exist) as mock_groups_exist,
+            patch.object(client, "get_group_members", wraps=client.get_group_members) as mock_get_group_members,
+        ):
+            for user in ("alice", "bob"):
+                add_user_to_group_set(user, {"group1", "group2"}, client=caching_client)
+            remove_user_from_group_set("alice", {"group1", "group2"}, client=caching_client)
+        mock_groups_exist.assert_called_once()
+        mock_get_group_members.assert_called_once_with("group1")
+        assert client.groups == {"group1": {"bob"}, "group2": {"bob"}}
+
+    def test_bulk_membership_changes_remembered(self):
+        client = UserManagementClient()
+        client.add_user_to_group("alice", "group1")
+        caching_client = CachingClient(client)
+        assert caching_client.get_group_members("group1") == {"alice"}
+        caching_client.add_users_to_group(["bob", "carol"], "group1")
+        caching_client.remove_users_from_group(["alice"], "group1")
+        assert caching_client.get_group_members("group1") == {"bob", "carol"}
+        assert client.groups["group1"] == {"bob", "carol"}
+
+
+class GetClientClassTests(TestCase):
+    @override_settings(USER_MANAGEMENT_CLIENT_PATH="user_management/tests/helpers.py")
+    def test_client_module_scanned_once(self):
+        client_class = get_client_class()
+        with patch("user_management.utils.inspect.getmembers") as mock_getmembers:
+            assert get_client_class() is client_class
+        mock_getmembers.assert_not_called()
+        assert client_class.__name__ == "UserManagementClient"
+
+    def test_client_class_named_by_module(self):
+        client_module = types.ModuleType("named_client")
+        client_module.USER_MANAGEMENT_CLIENT_CLASS = UserManagementClient
+        with patch("user_management.utils.inspect.getmembers") as mock_getmembers:
+            assert _find_client_class(client_module) is UserManagementClient
+        mock_getmembers.assert_not_called()
+
+    def test_client_without_optional_methods_found(self):
+        client_module = types.ModuleType("basic_client")
+
+        class BasicClient:
+            __module__ = client_module.__name__
+
+            get_config = UserManagementClient.get_config
+            test_config = UserManagementClient.test_config
+            add_user_to_group = UserManagementClient.add_user_to_group
+            remove_user_from_group = UserManagementClient.remove_user_from_group
+            user_in_group = UserManagementClient.user_in_group
+            group_exists = UserManagementClient.group_exists
+            get_group_members = UserManagementClient.get_group_members
+            create_group = UserManagementClient.create_group
+
+        client_module.BasicClient = BasicClient
+        assert _find_client_class(client_module) is BasicClient
+
+    def test_client_module_cached_by_absolute_path(self):
+        relative_path = "user_management/tests/helpers.py"
+        with override_settings(USER_MANAGEMENT_CLIENT_PATH=relative_path):
+            client_class = get_client_class()
+        with (
+            override_settings(USER_MANAGEMENT_CLIENT_PATH=str(Path(relative_path).resolve())),
+            patch("user_management.utils.importlib.util.spec_from_file_location") as mock_spec_from_file_location,
+        ):
+            assert get_client_class() is client_class
+        mock_spec_from_file_location.assert_not_called()
+
+
+class GroupSetTests(TestCase):
+    def setUp(self):
+        self.client = UserManagementClient()
+        patcher = patch("user_management.utils.get_client", return_value=self.client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_group_existence_looked_up_once_per_set(self):
+        self.client.create_group("group1")
+        with (
+            patch.object(self.client, "group_exists") as mock_group_exists,
+            patch.object(self.client, "groups_exist", wraps=self.client.groups_exist) as mock_groups_exist,
+        ):
+            add_user_to_group_set("alice", {"group1", "group2"})
+            remove_user_from_group_set("alice", {"group1", "group3"})
+        assert mock_groups_exist.call_count == 2
+        mock_group_exists.assert_not_called()
+        assert not self.client.user_in_group("alice", "group1")
+        assert self.client.user_in_group("alice", "group2")
+        assert not self.client.group_exists("group3")
+
+    def test_user_groups_read_once_per_set(self):
+        self.client.add_user_to_group("carol", "group1")
+        with (
+            patch.object(self.client, "get_group_members") as mock_get_group_members,
+            patch.object(self.client, "get_user_groups", wraps=self.client.get_user_groups) as mock_get_user_groups,
+        ):
+            add_user_to_group_set("carol", {"group1", "group2"})
+            remove_user_from_group_set("carol", {"group1", "group3"})
+        assert mock_get_user_groups.call_count == 2
+        mock_get_group_members.assert_not_called()
+        assert self.client.get_user_groups("carol") == {"group2"}
+
+    def test_failed_user_groups_lookup_reads_group_members(self):
+        self.client.add_user_to_group("dave", "group1")
+        with (
+            patch.object(self.client, "get_user_groups", side_effect=IOError("unavailable")),
+            patch.object(
+                self.client, "get_group_members", wraps=self.client.get_group_members
+            ) as mock_get_group_members,
+        ):
+            remove_user_from_group_set("dave", {"group1"})
+        mock_get_group_members.assert_called_once_with("group1")
+        assert not self.client.user_in_group("dave", "group1")
+
+    def test_error_callback_runs_in_caller_for_each_failed_group(self):
+        callback_threads = []
+        error_callback = Mock(side_effect=lambda pk: callback_threads.append(threading.current_thread()))
+        original_add = self.client.add_user_to_group
+
+        def add_user_to_group(user, group):
+            if group != "group1":
+                raise IOError("unavailable")
+            return original_add(user, group)
+
+        with patch.object(self.client, "add_user_to_group", side_effect=add_user_to_group):
+            add_user_to_group_set("erin", {"group1", "group2", "group3"}, error_callback, callback_args=(7,))
+        assert error_callback.call_args_list == [((7,),), ((7,),)]
+        assert callback_threads == [threading.current_thread()] * 2
+        assert self.client.get_user_groups("erin") == {"group1"}
+
+    @override_settings(USER_MANAGEMENT_SYNC_CONCURRENCY=1)
+    def test_unavailable_client_skips_remaining_groups(self):
+        error_callback = Mock()
+        with patch.object(
+            self.client, "remove_user_from_group", side_effect=ConnectionError("unavailable")
+        ) as mock_remove_user_from_group:
+            for group in ("group1", "group2", "group3"):
+                self.client.add_user_to_group("frank", group)
+            remove_user_from_group_set("frank", {"group1", "group2", "group3"}, error_callback, callback_args=(7,))
+        mock_remove_user_from_group.assert_called_once()
+        error_callback.assert_called_once_with(7)
+
+    def test_failed_existence_lookup_falls_back_to_each_group(self):
+        with patch.object(self.client, "groups_exist", side_effect=IOError("unavailable")):
+            add_user_to_group_set("bob", {"group1"})
+        assert self.client.user_in_group("bob", "group1")
+
+
+class CollectOtherProjectUserGroupsBulkTests(TestCase):
+    def test_matches_per_user_lookup(self):
+        active = ProjectStatusChoiceFactory(name="Active")
+        removed = ProjectUserStatusChoiceFactory(name="Removed")
+        group_attribute_type = ProjectAttributeTypeFactory(
+            name="ad_group", attribute_type=PAttributeTypeFactory(name="Text")
+        )
+        current = ProjectFactory(title="current", status=ProjectStatusChoiceFactory(name="Archived"))
+        other = ProjectFactory(title="other", status=active)
+        ProjectAttributeFactory(project=current, proj_attr_type=group_attribute_type, value="group1")
+        ProjectAttributeFactory(project=other, proj_attr_type=group_attribute_type, value="group1")
+        ProjectAttributeFactory(project=other, proj_attr_type=group_attribute_type, value="group2")
+        users = [UserFactory(username=f"user{i}") for i in range(3)]
+        for user in users:
+            ProjectUserFactory(project=current, user=user)
+        ProjectUserFactory(project=other, user=users[0])
+        ProjectUserFactory(project=other, user=users[1], status=removed)
+
+        with self.assertNumQueries(1):
+            result = collect_other_project_user_groups_bulk(users, "ad_group", current.pk)
+        assert result == {users[0].pk: {"group1", "group2"}}
+        for user in users:
+            assert result.get(user.pk, set()) == collect_other_project_user_groups(user, "ad_group", current.pk)
+
+
+class CollectOtherUserGroupsCandidateTests(TestCase):
+    def test_project_candidates_match_full_lookup(self):
+        active = ProjectStatusChoiceFactory(name="Active")
+        group_attribute_type = ProjectAttributeTypeFactory(
+            name="ad_group", attribute_type=PAttributeTypeFactory(name="Text")
+        )
+        current = ProjectFactory(title="current", status=active)
+        other = ProjectFactory(title="other", status=active)
+        for value in ("group1", "group2", "group3"):
+            ProjectAttributeFactory(project=other, proj_attr_type=group_attribute_type, value=value)
+        user = UserFactory(username="user0")
+        ProjectUserFactory(project=current, user=user)
+        ProjectUserFactory(project=other, user=user)
+
+        candidates = {"group1", "group2", "group4"}
+        other_groups = collect_other_project_user_groups(user, "ad_group", current.pk)
+        with self.assertNumQueries(1):
+            result = collect_other_project_user_groups(user, "ad_group", current.pk, candidate_groups=candidates)
+        assert result == other_groups & candidates == {"group1", "group2"}
+        result = collect_other_project_user_groups_bulk([user], "ad_group", current.pk, candidate_groups=candidates)
+        assert result == {user.pk: {"group1", "group2"}}
+
+    def test_allocation_candidates_match_full_lookup(self):
+        active = AllocationStatusChoiceFactory(name="Active")
+        group_attribute_type = AllocationAttributeTypeFactory(
+            name="ad_group", attribute_type=AAttributeTypeFactory(name="Text")
+        )
+        current = AllocationFactory(status=active)
+        other = AllocationFactory(status=active)
+        for value in ("group1", "group2", "group3"):
+            AllocationAttributeFactory(allocation=other, allocation_attribute_type=group_attribute_type, value=value)
+        user = UserFactory(username="user0")
+        AllocationUserFactory(allocation=current, user=user)
+        AllocationUserFactory(allocation=other, user=user)
+
+        candidates = {"group1", "group2", "group4"}
+        other_groups = collect_other_allocation_user_groups(user, "ad_group", current.pk)
+        with self.assertNumQueries(1):
+            result = collect_other_allocation_user_groups(user, "ad_group", current.pk, candidate_groups=candidates)
+        assert result == other_groups & candidates == {"group1", "group2"}
@@ -12,8 +12,18 @@ class UserManagementClient(Protocol):
     4. remove_user_from_group: Remove a user from a specified group.
     5. user_in_group: Check if a user is a member of a specified group.
     6. group_exists: Check if a specified group exists.
-    7. get_group_members: Retrieve the members of a specified group.
+    7. get_group_members: Retrieve the set of members of a specified group.
     8. create_group: Create a new group.
+    Clients may also provide these optional methods, which are used when present:
+    - groups_exist(groups) -> dict[str, bool]: Check whether several groups exist in one call.
+      Groups that couldn't be checked are left out of the result and are checked one at a time.
+    - get_user_groups(user) -> Iterable[str]: Retrieve the groups a user is a member of in one call.
+    - add_users_to_group(users, group) -> bool: Add several users to a specified group in one call.
+    - remove_users_from_group(users, group) -> bool: Remove several users from a specified group in one call.
+    Clients raise ConnectionError when the external system can't be reached and PermissionError when it
+    refuses the client's credentials; the rest of a user's groups are then skipped rather than tried one by one.
+    A new client is built for each task, so clients that talk to a remote service should keep their
+    connection pool (e.g. a requests.Session) at module level rather than opening one per instance.
     """
 
     @staticmethod
@@ -30,6 +40,6 @@ class UserManagementClient(Protocol):
 
     def group_exists(self, group: str) -> bool: ...
 
-    def get_group_members(self, group: str) -> list[str]: ...
+    def get_group_members(self, group: str) -> set[str]: ...
 
     def create_group(self, group: str) -> bool: ...
@@ -1,11 +1,15 @@
+import enum
+import functools
 import importlib.util
 import inspect
 import logging
 import sys
+from collections.abc import Set as AbstractSet
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
-from coldfront.core.allocation.models import Allocation
-from coldfront.core.project.models import Project, ProjectUser, ProjectUserStatusChoice
+from coldfront.core.allocation.models import AllocationAttribute
+from coldfront.core.project.models import ProjectAttribute, ProjectUser, ProjectUserStatusChoice
 from django.conf import settings
 
 from .user_management_client import UserManagementClient
@@ -13,16 +17,33 @@ from .user_management_client import UserManagementClient
 logger = logging.getLogger(__name__)
 
 
-class AlreadyMemberError(Exception):
-    pass
+class _GroupError(Exception):
+    """
+    Base for the expected outcomes of a group operation. Holds the user and group and only builds
+    the message when it's rendered, since these are usually caught and logged from the fields.
+    """
+
+    message = "group operation failed for user %(user)s and group %(group)s"
+
+    def __init__(self, user=None, group=None):
+        super().__init__(user, group)
+        self.user = user
+        self.group = group
+
+    def __str__(self):
+        return self.message % {"user": self.user, "group": self.group}
+
+
+class AlreadyMemberError(_GroupError):
+    message = "user %(user)s is already a member of group %(group)s"
 
 
-class NotMemberError(Exception):
-    pass
+class NotMemberError(_GroupError):
+    message = "user %(user)s is not a member of group %(group)s"
 
 
-class GroupDoesNotExistError(Exception):
-    pass
+class GroupDoesNotExistError(_GroupError):
+    message = "group %(group)s does not exist in grouper"
 
 
 def set_project_user_status_to_pending(project_user_pk):
@@ -35,7 +56,7 @@ def set_project_user_status_to_pending(project_user_pk):
     user_obj = ProjectUser.objects.get(pk=project_user_pk)
     pending_status = ProjectUserStatusChoice.objects.get(name="Pending")
     user_obj.status = pending_status
-    user_obj.save()
+    user_obj.save(update_fields=["status"])
 
 
 def get_project_attribute_values_set(project, attribute_name):
@@ -43,115 +64,349 @@ def get_project_attribute_values_set(project, attribute_name):
     return set(a.value for a in attr)
 
 
-def _add_user_to_group(user: str, group: str, client: UserManagementClient) -> None:
-    group_exists = client.group_exists(group)
+class CachingClient:
+    """
+    Wraps a user management client and remembers which groups exist and who their members are,
+    so a client shared across many users only asks about each group once.
+    Adds, removals and groups created through the wrapper keep what it remembers current.
+    Other methods are passed through to the wrapped client.
+    """
+
+    def __init__(self, client: UserManagementClient):
+        self._client = client
+        self._group_exists = {}
+        self._members = {}
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def group_exists(self, group):
+        if group not in self._group_exists:
+            self._group_exists[group] = self._client.group_exists(group)
+        return self._group_exists[group]
+
+    def groups_exist(self, groups):
+        uncached = [group for group in groups if group not in self._group_exists]
+        if uncached:
+            self._group_exists.update(_groups_exist(uncached, self._client))
+        return {group: self._group_exists[group] for group in groups if group in self._group_exists}
+
+    def get_group_members(self, group):
+        # callers only test membership, so the remembered set is returned as is
+        if group not in self._members:
+            self._members[group] = set(self._client.get_group_members(group))
+        return self._members[group]
+
+    def create_group(self, group):
+        created = self._client.create_group(group)
+        if created:
+            self._group_exists[group] = True
+            self._members[group] = set()
+        return created
+
+    def add_user_to_group(self, user, group):
+        added = self._client.add_user_to_group(user, group)
+        if added and group in self._members:
+            self._members[group].add(user)
+        return added
+
+    def remove_user_from_group(self, user, group):
+        removed = self._client.remove_user_from_group(user, group)
+        if removed and group in self._members:
+            self._members[group].discard(user)
+        return removed
+
+    def add_users_to_group(self, users, group):
+        added = self._client.add_users_to_group(users, group)
+        if added and group in self._members:
+            self._members[group].update(users)
+        return added
+
+    def remove_users_from_group(self, users, group):
+        removed = self._client.remove_users_from_group(users, group)
+        if removed and group in self._members:
+            self._members[group].difference_update(users)
+        return removed
+
+
+def _groups_exist(groups, client: UserManagementClient) -> dict[str, bool]:
+    """
+    Returns a dict mapping each group to whether it exists. Clients that provide groups_exist answer
+    for all the groups in one request; otherwise each group is looked up on its own.
+    A failed lookup isn't fatal: an empty dict is returned and each group is checked again as it's used.
+    """
+    try:
+        groups_exist = getattr(client, "groups_exist", None)
+        if groups_exist is not None:
+            return groups_exist(groups)
+        return {group: client.group_exists(group) for group in groups}
+    # pylint: disable=broad-except
+    except Exception as e:
+        logger.warning("Failed checking whether groups %s exist: %s", groups, e)
+        return {}
+
+
+def _get_user_groups(user: str, client: UserManagementClient):
+    """
+    Returns the set of groups the user is a member of, for clients that provide get_user_groups.
+    Returns None if the client can't list them or the lookup fails; each group's members are then read instead.
+    """
+    get_user_groups = getattr(client, "get_user_groups", None)
+    if get_user_groups is None:
+        return None
+    try:
+        return set(get_user_groups(user))
+    # pylint: disable=broad-except
+    except Exception as e:
+        logger.warning("Failed getting the groups of user %s: %s", user, e)
+        return None
+
+
+class AddResult(enum.Enum):
+    ADDED = "added"
+    ALREADY_MEMBER = "already a member"
+
+
+class RemoveResult(enum.Enum):
+    REMOVED = "removed"
+    NOT_MEMBER = "not a member"
+    GROUP_DOES_NOT_EXIST = "group does not exist"
+
+
+def _try_add_user_to_group(
+    user: str, group: str, client: UserManagementClient, group_exists=None, is_member=None
+) -> AddResult:
+    """Adds the user to the group, creating it if needed. Being a member already is reported, not raised."""
+    if group_exists is None:
+        group_exists = client.group_exists(group)
     if not group_exists:
         logger.info("Creating group %s...", group)
         client.create_group(group)
-    members = client.get_group_members(group)
-    if user in members:
-        raise AlreadyMemberError(f"user {user} is already a member of group {group}")
-    else:
+        # a group that was just created has no members to check
         client.add_user_to_group(user, group)
-
-
-def _remove_user_from_group(user: str, group: str, client: UserManagementClient) -> None:
-    group_exists = client.group_exists(group)
+        return AddResult.ADDED
+    if is_member is None:
+        is_member = user in client.get_group_members(group)
+    if is_member:
+        return AddResult.ALREADY_MEMBER
+    client.add_user_to_group(user, group)
+    return AddResult.ADDED
+
+
+def _add_user_to_group(user: str, group: str, client: UserManagementClient, group_exists=None, is_member=None) -> None:
+    if _try_add_user_to_group(user, group, client, group_exists, is_member) is AddResult.ALREADY_MEMBER:
+        raise AlreadyMemberError(user=user, group=group)
+
+
+def _try_remove_user_from_group(
+    user: str, group: str, client: UserManagementClient, group_exists=None, is_member=None
+) -> RemoveResult:
+    """Removes the user from the group. A missing group or membership is reported, not raised."""
+    if group_exists is None:
+        group_exists = client.group_exists(group)
     if not group_exists:
-        raise GroupDoesNotExistError(f"group {group} does not exist in grouper")
-    members = client.get_group_members(group)
-    if user not in members:
-        raise NotMemberError(f"user {user} is not a member of group {group}")
+        return RemoveResult.GROUP_DOES_NOT_EXIST
+    if is_member is None:
+        is_member = user in client.get_group_members(group)
+    if not is_member:
+        return RemoveResult.NOT_MEMBER
     client.remove_user_from_group(user, group)
+    return RemoveResult.REMOVED
+
+
+def _remove_user_from_group(
+    user: str, group: str, client: UserManagementClient, group_exists=None, is_member=None
+) -> None:
+    result = _try_remove_user_from_group(user, group, client, group_exists, is_member)
+    if result is RemoveResult.GROUP_DOES_NOT_EXIST:
+        raise GroupDoesNotExistError(user=user, group=group)
+    if result is RemoveResult.NOT_MEMBER:
+        raise NotMemberError(user=user, group=group)
 
 
-def add_user_to_group_set(user: str, groups: set[str], error_callback=None,
-                          callback_args=None) -> None:
-    client = get_client()
-    # validate that groups is a set
-    if not isinstance(groups, set):
-        raise ValueError("groups must be a set of group names")
-    for group in groups:
+def _run_for_groups(operation, user: str, groups, client: UserManagementClient, max_workers=None):
+    """
+    Calls operation(user, group, client, group_exists, is_member) for each of the groups and yields
+    (group, outcome) pairs, where outcome is the result the call returned or the exception it raised.
+    Each call is a series of blocking requests to the external system, so the groups are handled concurrently,
+    bounded by max_workers or, by default, USER_MANAGEMENT_SYNC_CONCURRENCY.
+    The results are yielded in the caller's thread, which can stop consuming them to skip the remaining groups.
+    """
+    existing = _groups_exist(groups, client)
+    # the user's memberships are read once when the client can list them, instead of every group's members
+    user_groups = _get_user_groups(user, client)
+
+    def run(group):
+        is_member = None if user_groups is None else group in user_groups
         try:
-            _add_user_to_group(user, group, client)
-        except AlreadyMemberError:
-            logger.warning("User %s is already a member of group %s", user, group)
+            return group, operation(user, group, client, existing.get(group), is_member)
         # pylint: disable=broad-except
-        except Exception as e:  # Catch all other exceptions
-            logger.error("Failed adding user %s to group %s: %s", user, group, e)
-            if error_callback:
-                if callback_args:
-                    error_callback(*callback_args)
-                else:
-                    error_callback()
+        except Exception as e:
+            return group, e
+
+    if max_workers is None:
+        max_workers = getattr(settings, "USER_MANAGEMENT_SYNC_CONCURRENCY", 8)
+    max_workers = min(max_workers, len(groups))
+    if max_workers < 2:
+        yield from map(run, groups)
+        return
+    # if the caller stops early, closing executor.map's iterator cancels the groups not yet started
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        yield from executor.map(run, groups)
+
+
+# errors clients raise when the external system can't be reached or won't accept their requests
+# (see UserManagementClient); the remaining groups would fail the same way, so the set operation stops
+_FATAL_CLIENT_ERRORS = (ConnectionError, PermissionError)
+
+
+def _handle_group_error(user: str, error: Exception, error_callback, callback_args) -> bool:
+    """Runs the error callback for a failed group operation. Returns True if the remaining groups should be skipped."""
+    if error_callback:
+        if callback_args:
+            error_callback(*callback_args)
         else:
+            error_callback()
+    if isinstance(error, _FATAL_CLIENT_ERRORS):
+        logger.error("User management client unavailable, skipping remaining groups for user %s", user)
+        return True
+    return False
+
+
+def add_user_to_group_set(
+    user: str, groups: AbstractSet[str], error_callback=None, callback_args=None, client=None, max_workers=None
+) -> None:
+    """
+    Adds the user to each of the groups, creating groups that don't exist yet.
+    A client can be passed in to share it, e.g. a CachingClient, across several calls.
+    max_workers limits how many of the groups are handled at once; 1 handles them one after another.
+    """
+    client = client or get_client()
+    # callers pass a set or frozenset, normalized once where the groups are looked up
+    assert isinstance(groups, AbstractSet), "groups must be a set of group names"
+    for group, outcome in _run_for_groups(_try_add_user_to_group, user, groups, client, max_workers):
+        if outcome is AddResult.ADDED:
             logger.info("Added user %s to group %s successfully", user, group)
+        elif outcome is AddResult.ALREADY_MEMBER:
+            logger.warning("User %s is already a member of group %s", user, group)
+        else:
+            logger.error("Failed adding user %s to group %s: %s", user, group, outcome)
+            if _handle_group_error(user, outcome, error_callback, callback_args):
+                break
 
 
-def remove_user_from_group_set(user: str, groups: set[str], 
-                               error_callback=None, callback_args=None) -> None:
-    client = get_client()
-    # validate that groups is a set
-    if not isinstance(groups, set):
-        raise ValueError("groups must be a set of group names")
-    for group in groups:
-        try:
-            _remove_user_from_group(user, group, client)
-        except NotMemberError:
+def remove_user_from_group_set(
+    user: str, groups: AbstractSet[str], error_callback=None, callback_args=None, client=None, max_workers=None
+) -> None:
+    """
+    Removes the user from each of the groups. Uses the client passed in, if any, instead of a new one.
+    max_workers limits how many of the groups are handled at once; callers that already run several
+    users concurrently pass 1 so the groups are handled one after another.
+    """
+    client = client or get_client()
+    # callers pass a set or frozenset, normalized once where the groups are looked up
+    assert isinstance(groups, AbstractSet), "groups must be a set of group names"
+    for group, outcome in _run_for_groups(_try_remove_user_from_group, user, groups, client, max_workers):
+        if outcome is RemoveResult.REMOVED:
+            logger.info("Removed user %s from group %s successfully", user, group)
+        elif outcome is RemoveResult.NOT_MEMBER:
             logger.warning("User %s is not a member of group %s", user, group)
-        except GroupDoesNotExistError:
+        elif outcome is RemoveResult.GROUP_DOES_NOT_EXIST:
             logger.warning("Group %s does not exist in grouper", group)
-        # pylint: disable=broad-except
-        except Exception as e:  # Catch all other exceptions
-            logger.error("Failed removing user %s from group %s: %s", user, group, e)
-            if error_callback:
-                if callback_args:
-                    error_callback(*callback_args)
-                else:
-                    error_callback()
         else:
-            logger.info("Removed user %s from group %s successfully", user, group)
+            logger.error("Failed removing user %s from group %s: %s", user, group, outcome)
+            if _handle_group_error(user, outcome, error_callback, callback_args):
+                break
 
 
-def collect_other_allocation_user_groups(user, group_attribute_name, current_allocation_id) -> list[str]:
-    other_user_allocations = (
-        Allocation.objects.filter(
-            allocationuser__user=user,
-            allocationuser__status__name="Active",
-            status__name="Active",
-            allocationattribute__allocation_attribute_type__name=group_attribute_name,
-        )
-        .exclude(pk=current_allocation_id)
+def collect_other_allocation_user_groups(
+    user, group_attribute_name, current_allocation_id, candidate_groups=None
+) -> set[str]:
+    """
+    Returns the groups the user belongs to in other active allocations, read with one query
+    that returns just the group attribute values.
+    If candidate_groups is given, only the candidate groups the user has elsewhere are returned.
+    """
+    # the user and status conditions share one filter() call so they apply to the same allocation user
+    values = AllocationAttribute.objects.filter(
+        allocation_attribute_type__name=group_attribute_name,
+        allocation__status__name="Active",
+        allocation__allocationuser__user=user,
+        allocation__allocationuser__status__name="Active",
+    ).exclude(allocation_id=current_allocation_id)
+    if candidate_groups is not None:
+        values = values.filter(value__in=candidate_groups)
+    return set(values.values_list("value", flat=True).distinct())
+
+
+def collect_other_project_user_groups(
+    user, group_attribute_name, current_project_id, candidate_groups=None
+) -> set[str]:
+    """
+    Returns the groups the user belongs to in other active projects, read with one query
+    that returns just the group attribute values.
+    If candidate_groups is given, only the candidate groups the user has elsewhere are returned.
+    """
+    # the user and status conditions share one filter() call so they apply to the same project user
+    values = ProjectAttribute.objects.filter(
+        proj_attr_type__name=group_attribute_name,
+        project__status__name="Active",
+        project__projectuser__user=user,
+        project__projectuser__status__name="Active",
+    ).exclude(project_id=current_project_id)
+    if candidate_groups is not None:
+        values = values.filter(value__in=candidate_groups)
+    return set(values.values_list("value", flat=True).distinct())
+
+
+def collect_other_project_user_groups_bulk(
+    users, group_attribute_name, current_project_id, candidate_groups=None
+) -> dict[int, set[str]]:
+    """
+    Returns a dict mapping the pk of each of the users to the groups they belong to in other active projects,
+    using a single query for all of them. Users without any other groups are left out of the dict.
+    If candidate_groups is given, only those groups are looked for.
+    """
+    other_groups = {}
+    # the user and status conditions share one filter() call so they apply to the same project user
+    project_attributes = ProjectAttribute.objects.filter(
+        proj_attr_type__name=group_attribute_name,
+        project__status__name="Active",
+        project__projectuser__user__in=users,
+        project__projectuser__status__name="Active",
+    )
+    if candidate_groups is not None:
+        project_attributes = project_attributes.filter(value__in=candidate_groups)
+    # a user usually shares a group with several other projects; only distinct pairs are sent back
+    project_attributes = (
+        project_attributes.exclude(project_id=current_project_id)
+        .values_list("project__projectuser__user_id", "value")
         .distinct()
     )
+    for user_id, value in project_attributes:
+        other_groups.setdefault(user_id, set()).add(value)
+    return other_groups
 
-    other_groups = []
-    for a in other_user_allocations:
-        other_groups.extend(a.get_attribute_list(group_attribute_name))
-    return set(other_groups)
 
+def _get_client_module():
+    # an unset, None or empty setting selects the included Grouper client
+    return _load_client_module(_resolve_client_path(getattr(settings, "USER_MANAGEMENT_CLIENT_PATH", None) or None))
 
-def collect_other_project_user_groups(user, group_attribute_name, current_project_id) -> set[str]:
-    other_user_projects = (
-        Project.objects.filter(
-            projectuser__user=user,
-            projectuser__status__name="Active",
-            status__name="Active",
-            projectattribute__proj_attr_type__name=group_attribute_name,
-        )
-        .exclude(pk=current_project_id)
-        .distinct()
-    )
 
-    other_groups = []
-    for p in other_user_projects:
-        other_groups.extend(get_project_attribute_values_set(p, group_attribute_name))
-    return set(other_groups)
+@functools.lru_cache(maxsize=None)
+def _resolve_client_path(client_path) -> Path:
+    """Returns the absolute path of the client module for the configured path. Cached per setting value."""
+    if client_path is None:
+        return (Path(sys.modules["user_management"].__file__).parent / "grouper_user_management_client.py").resolve()
+    return Path(client_path).resolve()
 
 
-def _get_client_module():
-    default_path = Path(sys.modules["user_management"].__file__).parent / "grouper_user_management_client.py"
-    path = Path(settings.USER_MANAGEMENT_CLIENT_PATH) if hasattr(settings, "USER_MANAGEMENT_CLIENT_PATH") and len(settings.USER_MANAGEMENT_CLIENT_PATH) > 0 else default_path
+@functools.lru_cache(maxsize=None)
+def _load_client_module(path: Path):
+    """
+    Loads the client module at path. Cached per absolute path, so the import machinery only runs once
+    even if the setting spells the same file differently.
+    """
     module_name = path.stem
 
     if module_name in sys.modules:
@@ -166,7 +421,18 @@ def _get_client_module():
 
 def get_client_class():
     """Returns an instance of the UserManagementClient subclass as specified in settings."""
-    client_module = _get_client_module()
+    return _find_client_class(_get_client_module())
+
+
+@functools.lru_cache(maxsize=None)
+def _find_client_class(client_module):
+    """
+    Finds the UserManagementClient subclass defined in client_module. Cached, so each module is scanned once.
+    A module can name its client class with USER_MANAGEMENT_CLIENT_CLASS, which skips the protocol checks.
+    """
+    client_class = getattr(client_module, "USER_MANAGEMENT_CLIENT_CLASS", None)
+    if client_class is not None:
+        return client_class
     classes = []
     for _, obj in inspect.getmembers(client_module, inspect.isclass):
         # Filter out imported classes and only include classes defined in this module